@@ -0,0 +1,37 @@
+'''
+작곡 모듈.
+
+numpy, pychord 등 무거운 module 은 실제로 곡을 만드는 worker process 에서만 필요하므로,
+서버 process 는 아래 함수만 참조하고 작곡 module 은 처음 호출될 때 불러옴.
+'''
+
+# 같은 seed 와 인자로 만드는 곡이 바뀌도록 작곡 module 을 고치면 올림.
+# 저장해 둔 음원의 cache key 에 포함되므로, 올리면 이전 버전으로 만든 음원은 다시 쓰지 않음.
+COMPOSER_VERSION = 1
+
+
+def make_song_bytes(**kwargs) -> bytes:
+    from .generator import make_song_bytes
+    return make_song_bytes(**kwargs)
+
+
+def make_song_timed(**kwargs) -> tuple[bytes, list[tuple[str, float]]]:
+    from .generator import make_song_timed
+    return make_song_timed(**kwargs)
+
+
+def compose_parts(**kwargs) -> dict:
+    from .generator import compose_parts
+    return compose_parts(**kwargs)
+
+
+def compose_parts_timed(**kwargs) -> tuple[dict, list[tuple[str, float]]]:
+    from .generator import compose_parts_timed
+    return compose_parts_timed(**kwargs)
+
+
+def preload():
+    '''
+    worker process 의 initializer. 첫 요청 전에 작곡 module 을 미리 불러옴.
+    '''
+    from . import generator
@@ -1,65 +1,22 @@
-from selectors import DefaultSelector
-import pretty_midi
+import logging
 import numpy as np
-import random
-from typing import Union
+from typing import BinaryIO, Union
 from pychord import Chord
 from .module.chord import *
 from .module.melody import *
 from .module.drum import *
+from .module.timeline import TICKS_PER_BEAT, build_timeline, part_ticks
+from .midi import MidiTrack, write_midi, to_pretty_midi
 from .util.music.util import *
+from .util.common.util import choice, timed
 
-class NoteWrapper:
-    def __init__(
-        self, 
-        notes, 
-        division, 
-        is_drum = False
-    ):
-        self.notes = notes
-        self.division = division
-        self.is_drum = is_drum
-
-    def __str__(self):
-        return f'notes: {self.notes}\ndivision: {self.division}'
-
-
-def apply_midi(
-    instrument,
-    start_base,
-    duration,
-    notes
-):
-    for (n, d) in notes:
-        note = pretty_midi.Note(
-            velocity=100, 
-            pitch=n,
-            start=start_base, 
-            end=start_base + d*duration
-        )
-        instrument.notes.append(note)
-        start_base += d*duration
+logger = logging.getLogger('main')
 
-    return start_base
+# section 의 순서
+SONG_FORM = ['inoutro', 'verse', 'chorus', 'verse', 'chorus', 'bridge', 'chorus', 'inoutro']
 
-def apply_drum(
-    drum_instrument,
-    start_base,
-    duration,
-    drum_notes,
-):
-    for n in drum_notes:
-        for drum_each in n:
-            note = pretty_midi.Note(
-                velocity=100,
-                pitch=drum_each,
-                start=start_base,
-                end=start_base + duration
-            )
-            drum_instrument.notes.append(note)
-        start_base += duration
-
-    return start_base
+# section 을 따로 렌더링할 때 section 이 끝난 뒤 release / reverb 를 위해 이어가는 시간 (초)
+PART_TAIL_SECONDS = 2.0
 
 def create_part(
     scale: Scale,
@@ -69,27 +26,25 @@ def create_part(
     bar_part: int=8,
     measure=(4,4),
     fill_in_pattern: DrumPattern | None=None,   # 없으면 걍 empty 로
+    rng: Union[np.random.Generator, None]=None,
 ):  
     bar_per_cp = chord_pattern.cp.bar_length
+    rng = rng if rng is not None else np.random.default_rng()
 
     if (bar_part < bar_per_cp):
         raise Exception('Song length is smaller than chord length!')
    
-    melody_primary = Melody(
+    # A, B 두 멜로디를 한 번에 만듦.
+    [melody_primary, melody_b] = Melody.generate_batch(
         scale=scale,
-        randomness=randomness,
         chord_progression=chord_pattern.cp,
-        measure=measure,
-        division=16
-    )
-    melody_diff = melody_primary.get_differ_melody(melody_randomness=0.5)
-    melody_b = Melody(
-        scale=scale,
         randomness=randomness,
-        chord_progression=chord_pattern.cp,
+        n=2,
+        division=16,
         measure=measure,
-        division=16
+        rng=rng,
     )
+    melody_diff = melody_primary.get_differ_melody(melody_randomness=0.5)
 
     # 기본적으로 AA'BA 형식을 따름
     if (bar_part == bar_per_cp):
@@ -103,19 +58,9 @@ def create_part(
     else:
         raise Exception('Unsupported bar length.')
 
-    melody_note_total = []
-    for melody in melodies:
-        if (melody.notes is None):
-            raise Exception('Empty melody notes')
-
-        melody_note_total.extend(melody.notes)
-    melody_wrapper = NoteWrapper(melody_note_total, melody_primary.division)
+    melody_notes = NoteArray.concat([melody.notes for melody in melodies])    # type: ignore
 
-    chords = [chord_pattern] * (bar_part // bar_per_cp)
-    chord_note_total = []
-    for chord in chords:
-        chord_note_total.extend(chord.notes)
-    chord_wrapper = NoteWrapper(chord_note_total, chord_pattern.division)
+    chord_notes = chord_pattern.notes.tile(bar_part // bar_per_cp)
 
     if fill_in_pattern is not None:
         real_division = max(drum_pattern.division, fill_in_pattern.division)
@@ -125,48 +70,40 @@ def create_part(
         real_division = drum_pattern.division
         real_drum_pattern = drum_pattern
 
-    drum_note_total = []
-    for _ in range(bar_part // real_drum_pattern.bar_length):
-        drum_note_total.extend(real_drum_pattern.pattern)
-    
-    if fill_in_pattern is not None:
-        start_index = real_drum_pattern.division * fill_in_pattern.bar_length
-        drum_note_total[-start_index:] = fill_in_pattern.pattern
+    drum_notes = real_drum_pattern.notes.tile(bar_part // real_drum_pattern.bar_length)
 
-    drum_wrapper = NoteWrapper(drum_note_total, real_drum_pattern.division, is_drum=True)
+    if fill_in_pattern is not None:
+        drum_notes = drum_notes.replace_tail(real_fill_in_pattern.notes)
 
-    return [melody_wrapper, chord_wrapper, drum_wrapper]
+    return [melody_notes, chord_notes, drum_notes]
 
 def merge_part(
-    part_list: list[list[NoteWrapper]],
-    instrument_list: list[pretty_midi.Instrument],
-    bpm: int,
-):
-    start_base = 0
-
-    for part in part_list:
-        if len(part) != len(instrument_list):
-            raise Exception(f'Must contain {len(instrument_list)} instruments.')
-
-        start_base_each = 0
-        for (note_wrapper, instrument) in zip(part, instrument_list):
-            duration = (1/note_wrapper.division) * (240/bpm)
-            if (note_wrapper.is_drum):
-                start_base_each = apply_drum(instrument, start_base, duration, note_wrapper.notes)
-            else:
-                start_base_each = apply_midi(instrument, start_base, duration, note_wrapper.notes)
-            start_base_each = np.round(start_base_each, decimals=4)
-
-        start_base = start_base_each
-
-def make_song(
+    part_list: list[list[NoteArray]],
+    instrument_list: list[MidiTrack],
+) -> list[np.ndarray]:
+    '''
+    part 들을 순서대로 이어 붙여 각 악기에 note 를 넣고, 악기별 timeline 을 반환.
+    '''
+    timeline = build_timeline(part_list)
+    if len(timeline) != len(instrument_list):
+        raise Exception(f'Must contain {len(instrument_list)} instruments.')
+
+    for (events, instrument) in zip(timeline, instrument_list):
+        instrument.add(events)
+
+    return timeline
+
+def plan_song(
     genre: str,
     mood: str,
-    music_path: str,
     tempo: str,
-    bpm: Union[int, None]=None,
-    max_randomness: float=0.7,
-):
+    bpm: Union[int, None],
+    max_randomness: float,
+    rng: np.random.Generator,
+) -> tuple[int, dict[str, dict]]:
+    '''
+    곡의 bpm 과, section 마다 create_part 에 넘길 인자 (rng 제외) 를 정함.
+    '''
     if genre not in ['newage', 'retro']:
         raise Exception('Unsupported genre.')
 
@@ -206,11 +143,11 @@ def make_song(
         cropped_bpm_list: list[list[int]] = divide_chunk_into(bpm_list, 3)
 
         if (tempo == 'slow'):
-            bpm = random.choice(cropped_bpm_list[0])
+            bpm = choice(cropped_bpm_list[0], rng)
         elif (tempo == 'moderate'):
-            bpm = random.choice(cropped_bpm_list[1])
+            bpm = choice(cropped_bpm_list[1], rng)
         else:
-            bpm = random.choice(cropped_bpm_list[2])
+            bpm = choice(cropped_bpm_list[2], rng)
 
     randomness_list = list(limitations[genre]['randomness'].intersection(limitations[mood]['randomness']))
 
@@ -218,39 +155,25 @@ def make_song(
     randomness_list = np.linspace(randomness_list[0], rand_limit_high, 50)
 
     randomness_selection = sorted([
-        random.choice(randomness_list),
-        random.choice(randomness_list),
-        random.choice(randomness_list),
-        random.choice(randomness_list),
+        choice(randomness_list, rng),
+        choice(randomness_list, rng),
+        choice(randomness_list, rng),
+        choice(randomness_list, rng),
     ])
 
-    print(randomness_selection, bpm)
+    logger.debug(f'randomness: {randomness_selection}, bpm: {bpm}')
 
-    instruments = {
-        'piano_acoustic': pretty_midi.Instrument(program=0),
-        'lead_square': pretty_midi.Instrument(program=80),
-        'lead_sawtooth': pretty_midi.Instrument(program=81),
-        'drum_acoustic': pretty_midi.Instrument(program=0, is_drum=True),
-    }
-    instruments_set = {
-        'newage': [instruments['piano_acoustic'], instruments['piano_acoustic'], instruments['drum_acoustic']],
-        'retro': [instruments['lead_square'], instruments['lead_sawtooth'], instruments['drum_acoustic']],
-    }
-
-    # song making start
-    output_midi = pretty_midi.PrettyMIDI()
-    [main_instrument, sub_instrument, drum_instrument] = instruments_set[genre]
-
-    deviation = random.randint(0, 11)
+    deviation = int(rng.integers(0, 11, endpoint=True))
     default_scale = MajorScale(get_transposed_root('C', deviation))
 
     chords_selection = []
     for _ in range(4):
-        random_chords = random.choice(chord_progressions)
+        random_chords = choice(chord_progressions, rng)
         cp = ChordProgression(list(random_chords))
         chords_selection.append(get_transposed_cp(cp, deviation))
 
-    inoutro = create_part(
+    sections = {}
+    sections['inoutro'] = dict(
         scale=default_scale,
         chord_pattern=ChordWithPattern(
             cp=Chords(chords_selection[0], 2),
@@ -262,7 +185,7 @@ def make_song(
         bar_part=4,
         measure=(4, 4),
     )
-    verse = create_part(
+    sections['verse'] = dict(
         scale=default_scale,
         chord_pattern=ChordWithPattern(
             cp=Chords(chords_selection[1], 2),
@@ -275,7 +198,7 @@ def make_song(
         measure=(4, 4),
         fill_in_pattern=drum_patterns['newage']['fill_in'][0],
     )
-    chorus = create_part(
+    sections['chorus'] = dict(
         scale=default_scale,
         chord_pattern=ChordWithPattern(
             cp=Chords(chords_selection[2], len(chords_selection[2]) // 2),
@@ -287,7 +210,7 @@ def make_song(
         bar_part=8,
         measure=(4, 4),
     )
-    bridge = create_part(
+    sections['bridge'] = dict(
         scale=default_scale,
         chord_pattern=ChordWithPattern(
             cp=Chords(chords_selection[3], 2),
@@ -301,16 +224,168 @@ def make_song(
         fill_in_pattern=drum_patterns['newage']['fill_in'][0],
     )
 
-    merge_part(
-        part_list=[inoutro, verse, chorus, verse, chorus, bridge, chorus, inoutro],
-        instrument_list=[main_instrument, sub_instrument, drum_instrument],
-        bpm=bpm,
-    )
+    return (int(bpm), sections)
+
+def make_instruments(genre: str) -> list[MidiTrack]:
+    '''
+    [main, sub, drum] 자리의 악기. 장르에 따라 같은 악기를 여러 자리에 쓸 수 있음.
+    '''
+    instruments = {
+        'piano_acoustic': MidiTrack(program=0, name='piano_acoustic'),
+        'lead_square': MidiTrack(program=80, name='lead_square'),
+        'lead_sawtooth': MidiTrack(program=81, name='lead_sawtooth'),
+        'drum_acoustic': MidiTrack(program=0, is_drum=True, name='drum_acoustic'),
+    }
+    instruments_set = {
+        'newage': [instruments['piano_acoustic'], instruments['piano_acoustic'], instruments['drum_acoustic']],
+        'retro': [instruments['lead_square'], instruments['lead_sawtooth'], instruments['drum_acoustic']],
+    }
+    return instruments_set[genre]
+
+def compose_sections(
+    genre: str,
+    mood: str,
+    tempo: str,
+    bpm: Union[int, None]=None,
+    max_randomness: float=0.7,
+    seed: Union[int, None]=None,
+    section_seeds: Union[dict[str, int], None]=None,
+    spans: Union[list, None]=None,
+) -> tuple[int, dict[str, list[NoteArray]]]:
+    '''
+    section 별 part 를 (bpm, {section: part}) 로 반환.
+    section_seeds 에 있는 section 은 곡의 seed 대신 해당 seed 로 다시 만듦.
+    이때도 원래 part 를 만들어 rng 를 같은 만큼 진행시키므로 다른 section 은 바뀌지 않음.
+    '''
+    rng = np.random.default_rng(seed)
+    with timed(spans, 'plan_song'):
+        (bpm, sections) = plan_song(genre, mood, tempo, bpm, max_randomness, rng)
+
+    # song making start
+    parts = {}
+    for (name, section) in sections.items():
+        with timed(spans, 'create_part'):
+            parts[name] = create_part(**section, rng=rng)
+            if section_seeds is not None and name in section_seeds:
+                parts[name] = create_part(**section, rng=np.random.default_rng(section_seeds[name]))
+
+    return (bpm, parts)
+
+def compose_song(
+    genre: str,
+    mood: str,
+    tempo: str,
+    bpm: Union[int, None]=None,
+    max_randomness: float=0.7,
+    seed: Union[int, None]=None,
+    section_seeds: Union[dict[str, int], None]=None,
+    playback_bpm: Union[int, None]=None,
+    spans: Union[list, None]=None,
+) -> tuple[list[MidiTrack], int]:
+    '''
+    곡을 만들어 (악기별 track, bpm) 으로 반환.
+    같은 seed 와 인자로 만든 곡은 항상 같음.
+    playback_bpm 이 주어지면 곡은 그대로 두고 bpm 만 바꿈.
+    spans 가 주어지면 단계별 소요 시간을 (단계, 초) 로 추가함.
+    '''
+    (bpm, parts) = compose_sections(genre, mood, tempo, bpm, max_randomness, seed, section_seeds, spans)
+    bpm = playback_bpm or bpm
+
+    instrument_list = make_instruments(genre)
+    with timed(spans, 'merge_part'):
+        merge_part(
+            part_list=[parts[name] for name in SONG_FORM],
+            instrument_list=instrument_list,
+        )
+
+    # 같은 악기를 여러 자리에 쓰면 track 하나로 합침.
+    tracks = list({id(track): track for track in instrument_list}.values())
+
+    return (tracks, bpm)
+
+def compose_parts(
+    genre: str,
+    mood: str,
+    tempo: str,
+    bpm: Union[int, None]=None,
+    max_randomness: float=0.7,
+    seed: Union[int, None]=None,
+    section_seeds: Union[dict[str, int], None]=None,
+    playback_bpm: Union[int, None]=None,
+    spans: Union[list, None]=None,
+) -> dict:
+    '''
+    section 마다 따로 렌더링할 수 있도록 곡을 section 별 midi 로 반환.
+        bpm     곡의 bpm
+        form    section 의 순서
+        parts   {section: {'midi': midi bytes, 'beats': section 의 길이 (박)}}
+    part midi 는 section 이 끝난 뒤에도 PART_TAIL_SECONDS 만큼 이어지므로 release / reverb 까지 렌더링됨.
+    playback_bpm 이 주어지면 곡은 그대로 두고 bpm 만 바꿈.
+    bpm 인자를 주면 plan_song 이 rng 를 덜 쓰므로 다른 곡이 됨.
+    '''
+    (bpm, parts) = compose_sections(genre, mood, tempo, bpm, max_randomness, seed, section_seeds, spans)
+    bpm = playback_bpm or bpm
+    tail_ticks = round(PART_TAIL_SECONDS * bpm / 60 * TICKS_PER_BEAT)
+
+    result = {}
+    for (name, part) in parts.items():
+        instrument_list = make_instruments(genre)
+        with timed(spans, 'merge_part'):
+            merge_part(part_list=[part], instrument_list=instrument_list)
+        tracks = list({id(track): track for track in instrument_list}.values())
+
+        ticks = part_ticks(part)
+        with timed(spans, 'midi_write'):
+            midi = write_midi(tracks, bpm, end_tick=ticks + tail_ticks)
+        result[name] = {'midi': midi, 'beats': ticks / TICKS_PER_BEAT}
+
+    return {'bpm': int(bpm), 'form': list(SONG_FORM), 'parts': result}
+
+def compose_parts_timed(**kwargs) -> tuple[dict, list[tuple[str, float]]]:
+    '''
+    compose_parts 의 결과와 단계별 소요 시간 [(단계, 초), ...] 을 함께 반환.
+    '''
+    spans = []
+    composition = compose_parts(**kwargs, spans=spans)
+    return (composition, spans)
+
+def make_song_bytes(
+    music_path: Union[str, BinaryIO, None]=None,
+    **kwargs,
+) -> bytes:
+    '''
+    compose_song 의 결과를 midi bytes 로 반환.
+    music_path 가 주어지면 해당 경로나 file object 에도 씀.
+    bytes 는 작으므로 process 간에 주고받기 좋음.
+    '''
+    (tracks, bpm) = compose_song(**kwargs)
+    with timed(kwargs.get('spans'), 'midi_write'):
+        return write_midi(tracks, bpm, music_path)
+
+def make_song_timed(**kwargs) -> tuple[bytes, list[tuple[str, float]]]:
+    '''
+    make_song_bytes 의 결과와 단계별 소요 시간 [(단계, 초), ...] 을 함께 반환.
+    worker process 에서 잰 시간을 서버 process 로 돌려주기 위해 사용.
+    '''
+    spans = []
+    midi = make_song_bytes(**kwargs, spans=spans)
+    return (midi, spans)
+
+def make_song(
+    music_path: Union[str, BinaryIO, None]=None,
+    **kwargs,
+):
+    '''
+    디버깅용. compose_song 의 결과를 PrettyMIDI 로 반환.
+    music_path 가 주어지면 pretty_midi 로 midi 를 씀.
+    '''
+    (tracks, bpm) = compose_song(**kwargs)
+    output_midi = to_pretty_midi(tracks, bpm)
+
+    if music_path is not None:
+        output_midi.write(music_path)
 
-    output_midi.instruments.append(main_instrument)
-    output_midi.instruments.append(sub_instrument)
-    output_midi.instruments.append(drum_instrument)
-    output_midi.write(music_path)
+    return output_midi
 
 if __name__ == '__main__':
     make_song(
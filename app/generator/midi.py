@@ -0,0 +1,162 @@
+import struct
+from typing import BinaryIO, Union
+import numpy as np
+from .module.timeline import EVENT_DTYPE, TICKS_PER_BEAT
+
+DRUM_CHANNEL = 9
+
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+META = 0xFF
+META_TRACK_NAME = 0x03
+META_END_OF_TRACK = 0x2F
+META_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+
+
+class MidiTrack:
+    '''
+    악기 하나의 note 들. events 는 tick 단위의 EVENT_DTYPE 배열.
+    '''
+    __slots__ = ('name', 'program', 'is_drum', 'events')
+
+    def __init__(
+        self,
+        program: int,
+        is_drum: bool = False,
+        name: str = '',
+    ):
+        self.name = name
+        self.program = program
+        self.is_drum = is_drum
+        self.events = np.empty(0, dtype=EVENT_DTYPE)
+
+    def add(self, events: np.ndarray):
+        self.events = np.concatenate((self.events, events))
+
+
+def _var_len(value: int) -> bytes:
+    '''
+    MIDI 의 가변 길이 정수. 7bit 씩 나누어 마지막 byte 를 제외하고 최상위 bit 를 켬.
+    '''
+    result = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def _meta(kind: int, data: bytes, delta: int = 0) -> bytes:
+    return _var_len(delta) + bytes([META, kind]) + _var_len(len(data)) + data
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return kind + struct.pack('>I', len(data)) + data
+
+
+def _note_events(events: np.ndarray, channel: int) -> bytes:
+    '''
+    note on / off 를 delta time 과 running status 로 직렬화.
+
+    note off 는 velocity 0 인 note on 으로 쓰므로 모든 event 의 status 가 같고,
+    첫 event 외에는 status byte 를 생략할 수 있음.
+    같은 tick 에서는 note off 가 먼저 오므로, 같은 음을 연달아 쳐도 끊기지 않음.
+    '''
+    if len(events) == 0:
+        return b''
+
+    ticks = np.concatenate((events['end'], events['start']))
+    is_on = np.repeat([False, True], len(events))
+    pitch = np.tile(events['pitch'], 2)
+    velocity = np.concatenate((np.zeros(len(events), dtype=np.uint8), events['velocity']))
+
+    order = np.lexsort((is_on, ticks))
+    delta = np.diff(ticks[order], prepend=0)
+
+    if delta.max() >= 1 << 28:
+        raise Exception('Song is too long for a MIDI file.')
+
+    # 한 행이 한 event. [가변 길이 delta time 4칸, status, pitch, velocity] 중 쓰는 칸만 남김.
+    rows = np.empty((len(delta), 7), dtype=np.uint8)
+    for (i, shift) in enumerate((21, 14, 7, 0)):
+        rows[:, i] = ((delta >> shift) & 0x7F) | (0x80 if shift > 0 else 0)
+    rows[:, 4] = NOTE_ON | channel
+    rows[:, 5] = pitch[order]
+    rows[:, 6] = velocity[order]
+
+    delta_len = 1 + (delta >= 1 << 7) + (delta >= 1 << 14) + (delta >= 1 << 21)
+    mask = np.ones(rows.shape, dtype=np.bool_)
+    mask[:, :4] = np.arange(4) >= 4 - delta_len[:, np.newaxis]
+    mask[1:, 4] = False
+
+    return rows[mask].tobytes()
+
+
+def write_midi(
+    tracks: list[MidiTrack],
+    bpm: int,
+    file: Union[str, BinaryIO, None] = None,
+    end_tick: Union[int, None] = None,
+) -> bytes:
+    '''
+    Standard MIDI File (format 1) 로 직렬화.
+    첫 track 은 tempo / 박자, 이후 악기마다 track 하나. drum 은 channel 9 를 사용.
+    file 이 주어지면 해당 경로나 file object 에도 씀.
+    end_tick 이 주어지면 마지막 note 가 끝난 뒤에도 모든 track 을 그 tick 까지 이어감.
+    '''
+    def end_of_track(last_tick: int) -> bytes:
+        delta = max(0, end_tick - last_tick) if end_tick is not None else 0
+        return _meta(META_END_OF_TRACK, b'', delta)
+
+    conductor = b''.join([
+        _meta(META_TIME_SIGNATURE, bytes([4, 2, 24, 8])),
+        _meta(META_TEMPO, round(60_000_000 / bpm).to_bytes(3, 'big')),
+        end_of_track(0),
+    ])
+    chunks = [_chunk(b'MTrk', conductor)]
+
+    channels = (channel for channel in range(16) if channel != DRUM_CHANNEL)
+    for track in tracks:
+        channel = DRUM_CHANNEL if track.is_drum else next(channels)
+
+        chunks.append(_chunk(b'MTrk', b''.join([
+            _meta(META_TRACK_NAME, track.name.encode()),
+            bytes([0, PROGRAM_CHANGE | channel, track.program]),
+            _note_events(track.events, channel),
+            end_of_track(int(track.events['end'].max()) if len(track.events) > 0 else 0),
+        ])))
+
+    header = _chunk(b'MThd', struct.pack('>HHH', 1, len(chunks), TICKS_PER_BEAT))
+    data = header + b''.join(chunks)
+
+    if isinstance(file, str):
+        with open(file, 'wb') as f:
+            f.write(data)
+    elif file is not None:
+        file.write(data)
+
+    return data
+
+
+def to_pretty_midi(tracks: list[MidiTrack], bpm: int):
+    '''
+    디버깅용. 같은 곡을 PrettyMIDI 로 변환.
+    '''
+    import pretty_midi
+
+    output_midi = pretty_midi.PrettyMIDI(resolution=TICKS_PER_BEAT, initial_tempo=bpm)
+    seconds_per_tick = 60 / (bpm * TICKS_PER_BEAT)
+
+    for track in tracks:
+        instrument = pretty_midi.Instrument(program=track.program, is_drum=track.is_drum, name=track.name)
+        instrument.notes.extend(map(
+            pretty_midi.Note,
+            track.events['velocity'].tolist(),
+            track.events['pitch'].tolist(),
+            (track.events['start'] * seconds_per_tick).tolist(),
+            (track.events['end'] * seconds_per_tick).tolist(),
+        ))
+        output_midi.instruments.append(instrument)
+
+    return output_midi
@@ -1,7 +1,12 @@
+import functools
 from typing import Union
 from pychord import Chord, ChordProgression
-import pretty_midi
 import numpy as np
+from .scale import Scale, MELODY_LIMIT
+from .note import NoteArray
+from ..util.music.util import note_name_to_number, note_number_to_name
+
+CHORD_CACHE_SIZE = 1024     # 요청 간에 공유되는 코드 구성음 cache 의 최대 크기
 
 chord_progressions = [
     ('Dm7', 'G7', 'CM7', 'CM7'),
@@ -23,6 +28,30 @@ chord_progressions = [
 ]
 
 
+@functools.lru_cache(maxsize=CHORD_CACHE_SIZE)
+def chord_pitches(chord_name: str, octave: int) -> np.ndarray:
+    '''
+    코드 구성음을 octave 에서 시작하는 midi number 로 변환. ex) ('Am7', 2) -> [45, 48, 52, 55]
+    pychord 의 문자열 파싱은 느리므로 코드 이름과 octave 로 cache 함. 반환된 배열은 읽기 전용.
+    '''
+    components = Chord(chord_name).components_with_pitch(octave)
+    pitches = np.array([note_name_to_number(c) for c in components])
+    pitches.flags.writeable = False
+    return pitches
+
+
+@functools.lru_cache(maxsize=CHORD_CACHE_SIZE)
+def chord_melody_notes(chord_name: str) -> np.ndarray:
+    '''
+    MELODY_LIMIT 안에 있는 코드 구성음. 오름차순으로 정렬된 읽기 전용 배열.
+    '''
+    pitch_classes = chord_pitches(chord_name, 4) % Scale.OCTAVE
+    limit = np.arange(MELODY_LIMIT.start, MELODY_LIMIT.stop)
+    notes = limit[np.isin(limit % Scale.OCTAVE, pitch_classes)]
+    notes.flags.writeable = False
+    return notes
+
+
 class Chords:
     def __init__(
         self,
@@ -90,15 +119,11 @@ class ChordWithPattern:
 
     def __str__(self, with_name=True):
         if (not with_name):
-            return str(self.notes)
-
-        notes = np.array(self.notes)
-        note_numbers = notes[:, 0]
-        note_durations = notes[:, 1]
+            return str(self.notes.to_pairs())
 
         res = []
-        for (name, duration) in zip(note_numbers, note_durations):
-            res.append([pretty_midi.note_number_to_name(name), duration])
+        for (name, duration) in self.notes:
+            res.append([note_number_to_name(name), duration])
 
         return str(res)
 
@@ -108,18 +133,17 @@ class ChordWithPattern:
         chord_pattern = self.pattern.pattern * pattern_nums
         dur_pattern = self.pattern.duration * pattern_nums
 
-        chord_pattern_with_dur: list[tuple[int, int]] = []
+        steps_per_chord = len(chord_pattern) // self.cp.chord_nums
+
+        pitch = np.empty(len(chord_pattern), dtype=np.int64)
         for (i, pat) in enumerate(chord_pattern):
             
-            curr_chord: Chord = self.cp.cp[i // (len(chord_pattern) // self.cp.chord_nums)]
-            chord_component = curr_chord.components_with_pitch(ChordWithPattern.DEFAULT_PITCH)
+            curr_chord: Chord = self.cp.cp[i // steps_per_chord]
+            chord_component = chord_pitches(curr_chord.chord, ChordWithPattern.DEFAULT_PITCH)
 
             note_pitch = pat // 12
             note_order = (pat % 12) % len(chord_component)
 
-            note = pretty_midi.note_name_to_number(chord_component[note_order])
-            note += note_pitch * 12
-
-            chord_pattern_with_dur.append((note, dur_pattern[i]))
+            pitch[i] = chord_component[note_order] + note_pitch * 12
 
-        self.notes = chord_pattern_with_dur
+        self.notes = NoteArray.from_columns(pitch, dur_pattern, self.division)
@@ -1,6 +1,7 @@
 import numpy as np
 import copy
 from typing import Sequence
+from .note import NoteArray
 
 
 class DrumPattern():
@@ -40,25 +41,26 @@ class DrumPattern():
             raise Exception("Length of patterns don't match!")
 
 
-        self.pattern = list(zip(*drums))
+        # (칸 수, 악기 수) 크기. 각 칸은 악기별 midi number 이고, 치지 않으면 0.
+        self.pattern = np.stack(drums, axis=1)
         self.division = division
         self.bar_length = bar_length
 
+    @property
+    def notes(self) -> NoteArray:
+        return NoteArray.from_drum(self.pattern, self.division)
+
 def multiplyDivision(drum_pattern: DrumPattern, ratio: float) -> DrumPattern:
     intRatio = int(ratio)
 
     new_pattern = copy.copy(drum_pattern)
     new_pattern.division *= intRatio
-    
-    temp_pattern = []
-    for p in drum_pattern.pattern:
-        for i in range(intRatio):
-            if i == 0: 
-                temp_pattern.append(p)
-            else:
-                temp_tuple = tuple(0 for x in p)
-                temp_pattern.append(temp_tuple)
-            
+
+    # 원래의 각 칸 뒤에 빈 칸을 intRatio - 1 개씩 넣음.
+    (steps, voices) = drum_pattern.pattern.shape
+    temp_pattern = np.zeros((steps * intRatio, voices), dtype=drum_pattern.pattern.dtype)
+    temp_pattern[::intRatio] = drum_pattern.pattern
+
     new_pattern.pattern = temp_pattern
     return new_pattern
 
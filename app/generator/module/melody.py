@@ -1,11 +1,13 @@
-import pretty_midi
+import functools
 import numpy as np
-import random
+from statistics import NormalDist
 from typing import Union
 from pychord import Chord, ChordProgression
-from .chord import Chords
+from .chord import Chords, chord_melody_notes
+from .note import NoteArray
 from .scale import *
 from ..util.common.util import divide_chunk_into
+from ..util.music.util import note_number_to_name
 
 
 class MelodyPattern:
@@ -15,25 +17,30 @@ class MelodyPattern:
     Pattern is binary array. ex) [True, False, False, ...]
     The melody will be played only for True value.
     '''
+    MIN_ONSETS = 3      # 한 패턴에 최소한 있어야 하는 note 수
 
     def __init__(
         self,
         randomness,
         bar_length = 1,
         division = 16,
-        measure = (4, 4)
+        measure = (4, 4),
+        rng: Union[np.random.Generator, None] = None,
+        pattern: Union[np.ndarray, None] = None,
     ):
         self.randomness = randomness            # 무작위도
         self.bar_length = bar_length            # 마디 개수
         self.division = division                # 한 마디를 몇 개로 나눌건지
         self.measure = measure                  # 박자
+        self.rng = rng if rng is not None else np.random.default_rng()
 
         self._make_probability_distribution()   # pattern을 생성할 확률분포
-        self.build_pattern()                    # 멜로디 패턴
 
-        # note가 두 개 이하면 다시 생성.
-        while sum(self.pattern) <= 2:
-            self.build_pattern()
+        # pattern 이 주어지면 (Melody.generate_batch 로 만든 경우) 그대로 사용.
+        if (pattern is None):
+            self.build_pattern()                # 멜로디 패턴
+        else:
+            self.pattern = pattern
 
     def __repr__(self):
         return self.pattern
@@ -41,22 +48,22 @@ class MelodyPattern:
     def __str__(self):
         return str(self.pattern)
 
-    # 주어진 확률에 따라 1 또는 0 선택.
-    @staticmethod
-    def _choice(p):
-        return random.choices(
-            population=[1, 0],
-            weights=[p, 1 - p],
-            k=1
-        )[0]
-
     # 패턴의 확률분포를 만듦.
     # 큰 randomness는 더욱 분산이 큰 분포를 만듦 = 높은 엔트로피.
     def _make_probability_distribution(self):
-        depth = np.log2(self.division).astype(np.uint8) - 1
+        self._pd = MelodyPattern.probability_distribution(
+            self.randomness,
+            self.bar_length,
+            self.division,
+            self.measure,
+        )
+
+    @staticmethod
+    def probability_distribution(randomness, bar_length, division, measure) -> np.ndarray:
+        depth = np.log2(division).astype(np.uint8) - 1
         weights = np.zeros(depth)
 
-        r = self.randomness
+        r = randomness
         primary = -0.5*(r - 2)
 
         def h(x, a): return x/a
@@ -68,26 +75,45 @@ class MelodyPattern:
         for i in range(depth - 1):
             weights[i+1] = (1-h(r, 2**i))*(1-primary) + h(r, 2**i)*primary
 
-        pd = np.zeros(self.bar_length * self.division)
+        pd = np.zeros(bar_length * division)
 
         for i in reversed(range(depth)):
-            step = (self.division // self.measure[1]) // 2**i
+            step = (division // measure[1]) // 2**i
             pd[::step] = weights[i]
 
-        self._pd = pd
+        return pd
+
+    @staticmethod
+    def build_patterns(pd: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+        '''
+        확률분포 pd 로 (n, len(pd)) 크기의 bool 패턴을 한 번에 생성.
+
+        note 가 MIN_ONSETS 개보다 적은 패턴은 다시 뽑는 대신,
+        비어있는 칸 중에서 pd 에 비례하는 확률로 모자란 만큼만 채움.
+        '''
+        patterns = rng.random((n, len(pd))) < pd
+        min_onsets = min(MelodyPattern.MIN_ONSETS, len(pd))
+
+        for row in np.flatnonzero(patterns.sum(axis=1) < min_onsets):
+            empty = np.flatnonzero(~patterns[row])
+            weights = pd[empty]
+            if (weights.sum() <= 0):
+                weights = np.ones(len(empty))
+
+            missing = min_onsets - (len(pd) - len(empty))
+            filled = rng.choice(empty, size=missing, replace=False, p=weights / weights.sum())
+            patterns[row, filled] = True
+
+        return patterns
 
     # 확률분포에 따라 패턴 생성.
     def build_pattern(self):
-        pattern = [MelodyPattern._choice(p) for p in list(self._pd)]
-        self.pattern = pattern
+        self.pattern = MelodyPattern.build_patterns(self._pd, 1, self.rng)[0]
 
 
 class Melody():
     # 멜로디가 올라갈 / 내려갈 수 있는 한계.
-    limit = range(
-        pretty_midi.note_name_to_number('E4'),
-        pretty_midi.note_name_to_number('E6') + 1
-    )
+    limit = MELODY_LIMIT
     __RANDOM_WEIGHT = 3
 
     def __init__(
@@ -99,11 +125,13 @@ class Melody():
         ref_note = 0,
         measure: tuple[int, int] = (4, 4),
         pattern: Union[MelodyPattern, None] = None,
-        notes: Union[list[tuple[int, int]], None] = None,
-        velocity: Union[list[int], None] = None
+        notes: Union[NoteArray, list[tuple[int, int]], None] = None,
+        velocity: Union[list[int], None] = None,
+        rng: Union[np.random.Generator, None] = None,
     ):
         self.scale: Scale = scale
-        self.notes = notes
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.notes = notes if (notes is None or isinstance(notes, NoteArray)) else NoteArray.from_pairs(notes, division)
         self.velocity = velocity
         self.chord_progression = chord_progression
         self.start_chord = Chord('CM7')
@@ -114,17 +142,16 @@ class Melody():
         self.bar_length = chord_progression.bar_length
 
         if (scale.scale is not None):
-            self.usable_notes = list(set(Melody.limit).intersection(scale.scale))
+            self.usable_notes = scale.usable_notes
 
         # randomness와 pattern을 동시에 넘겨주면, randomness는 pattern에 영향을 주지 않음.
         # 즉, 주어진 pattern으로 고정.
         if (pattern is None):
-            self.melody_pattern = MelodyPattern(randomness, chord_progression.bar_length, division, measure)
+            self.melody_pattern = MelodyPattern(randomness, chord_progression.bar_length, division, measure, self.rng)
         else:
             self.melody_pattern = pattern
 
         if (notes is None):
-            self.notes = []
             self.build_melody()
 
         if (velocity is None):
@@ -133,144 +160,180 @@ class Melody():
 
     def __str__(self, with_name=True):
         if (not with_name):
-            return str(self.notes)
-
-        notes = np.array(self.notes)
-        note_numbers = notes[:, 0]
-        note_durations = notes[:, 1]
+            return str(self.notes.to_pairs())
 
         res = []
-        for (name, duration) in zip(note_numbers, note_durations):
-            res.append([pretty_midi.note_number_to_name(name), duration])
+        for (name, duration) in self.notes:
+            res.append([note_number_to_name(name), duration])
 
         return str(res)
 
     @staticmethod
-    def _calc_next_note(curr_note_number, usable_notes, randomness):
+    def _calc_next_note(curr_note_number, usable_notes, randomness, rng: np.random.Generator):
         '''
         return next_note's number
         '''
         curr_note_index = find_nearest(usable_notes, curr_note_number)[0]
-
-        while True:
-            next_dist = np.random.normal(curr_note_index, Melody.__RANDOM_WEIGHT*randomness + 0.1)
-            next_note_index = np.floor(next_dist).astype(int)
-
-            if (0 <= next_note_index < len(usable_notes)):
-                return usable_notes[next_note_index]
-
-    @staticmethod
-    def _choose_from_chord(chord: Chord, curr_note, randomness=0):
-        '''
-        return next_note's number
-        '''
-
-        chord_notes_number = []
-        for c in chord.components():
-            chord_notes_number.append(pretty_midi.note_name_to_number(f'{c}4'))
-        
-        weight = np.arange(-3, 5) * Scale.OCTAVE
-        chord_notes_number = np.array(chord_notes_number)
-        result_chord_notes = []
-
-        for w in weight:
-            result_chord_notes.extend(chord_notes_number - w)
-        
-        chord_notes_number = list(set(result_chord_notes).intersection(Melody.limit))
-
-        if (curr_note == 0):
-            return random.choice(chord_notes_number)
-
-        pivot_idx = find_nearest(chord_notes_number, curr_note)[0]
-
-        while True:
-            next_dist = np.random.normal(
-                pivot_idx, Melody.__RANDOM_WEIGHT*randomness+0.1)
-            next_note_idx = np.floor(next_dist).astype(int)
-
-            if (0 <= next_note_idx < len(chord_notes_number)):
-                return chord_notes_number[next_note_idx]
+        next_note_index = truncated_normal_index(
+            curr_note_index,
+            Melody.__RANDOM_WEIGHT*randomness + 0.1,
+            len(usable_notes),
+            rng,
+        )
+        return usable_notes[next_note_index]
 
     def build_melody(self):
         '''
         코드 진행을 마디 크기로 분할 후, 각 마디별로 멜로디 제작
         '''
+        pattern = np.asarray(self.melody_pattern.pattern, dtype=np.bool_)[np.newaxis]
+        uniforms = self.rng.random(pattern.shape)
 
-        cps = divide_chunk_into(self.chord_progression.cp, self.bar_length)
-        patterns = divide_chunk_into(self.melody_pattern.pattern, self.bar_length)
+        [self.notes], [self.ref_note] = Melody._compose(
+            scale=self.scale,
+            chord_progression=self.chord_progression,
+            division=self.division,
+            randomness=self.randomness,
+            patterns=pattern,
+            uniforms=uniforms,
+            ref_note=self.ref_note,
+        )
 
-        notes = []
-        for (cp, pattern) in zip(cps, patterns):
-            bar_notes = self._make_bar(cp, pattern, self.ref_note)  # type: ignore
-            self.ref_note = bar_notes[-1][0]
-            notes.extend(bar_notes)
+    @staticmethod
+    def generate_batch(
+        scale: Scale,
+        chord_progression: Chords,
+        randomness,
+        n: int,
+        division = 16,
+        measure: tuple[int, int] = (4, 4),
+        rng: Union[np.random.Generator, None] = None,
+    ) -> list['Melody']:
+        '''
+        같은 코드 진행 위에서 n 개의 Melody 를 한 번에 만듦.
+
+        i 번째 Melody 는 rng.spawn(n)[i] 를 rng 로 넘겨서 하나씩 만든 Melody 와 같은 음을 가짐.
+        각 Melody 의 난수는 미리 배열로 뽑아두고, 시간 순서로 진행하면서 n 개의 음을 동시에 계산함.
+        '''
+        rng = rng if rng is not None else np.random.default_rng()
+        children = rng.spawn(n)
+        bar_length = chord_progression.bar_length
+
+        pd = MelodyPattern.probability_distribution(randomness, bar_length, division, measure)
+        patterns = []
+        uniforms = []
+        for child in children:
+            # Melody 의 생성자와 같은 순서로 난수를 사용해야 같은 결과가 나옴.
+            patterns.append(MelodyPattern.build_patterns(pd, 1, child)[0])
+            uniforms.append(child.random(len(pd)))
+
+        notes_list, ref_notes = Melody._compose(
+            scale=scale,
+            chord_progression=chord_progression,
+            division=division,
+            randomness=randomness,
+            patterns=np.array(patterns),
+            uniforms=np.array(uniforms),
+        )
 
-        self.notes = notes
+        melodies = []
+        for (child, pattern, notes, ref_note) in zip(children, patterns, notes_list, ref_notes):
+            melody = Melody(
+                scale=scale,
+                randomness=randomness,
+                chord_progression=chord_progression,
+                division=division,
+                ref_note=ref_note,
+                measure=measure,
+                pattern=MelodyPattern(randomness, bar_length, division, measure, child, pattern=pattern),
+                notes=notes,
+                rng=child,
+            )
+            melodies.append(melody)
+
+        return melodies
 
-    def _make_bar(self, cp: ChordProgression, pattern: list[int], ref_note=0):
+    @staticmethod
+    def _compose(
+        scale: Scale,
+        chord_progression: Chords,
+        division: int,
+        randomness,
+        patterns: np.ndarray,
+        uniforms: np.ndarray,
+        ref_note = 0,
+    ) -> tuple[list[NoteArray], list[int]]:
         '''
-        한 마디에 해당하는 멜로디를 만듦
+        (n, 칸 수) 크기의 패턴과 난수로 n 개의 멜로디를 만듦.
+        음은 칸마다 n 개를 동시에 계산하고, note 는 각 melody 의 onset 위치로부터 만듦.
+
+        마디마다 첫 onset 앞의 쉼표를 [0, 길이] 로 넣고, 이후 onset 마다 [음, 다음 onset 까지의 길이] 를 넣음.
+        마디의 첫 음은 이전 마디의 마지막 음 (없으면 0) 에서 출발함.
+        코드가 시작되는 칸의 음은 코드 구성음에서, 나머지는 해당 코드의 스케일에서 고름.
         '''
-        cp_len = len(cp)
-        note_num_for_each_chord = self.division // cp_len
-
-        scale = self.scale
-
-        is_first_note = True
-        note_number = 0
-        note_len = 0
-        notes = []
-
-        usable_notes = self.usable_notes
-        for (idx, p) in enumerate(pattern):
-            nth_chord = idx // note_num_for_each_chord
-            is_first_note_of_chord = idx % note_num_for_each_chord == 0
-            curr_chord = cp[nth_chord]
-
-            if (is_first_note_of_chord):
-                # 해당 코드의 첫 음 처리
-                if (self.scale.has_chord(curr_chord)):
-                    scale = self.scale
+        (n, cells) = patterns.shape
+        bar_length = chord_progression.bar_length
+        std = Melody.__RANDOM_WEIGHT*randomness + 0.1
+
+        cps = divide_chunk_into(chord_progression.cp, bar_length)
+        pitches = np.zeros((n, cells), dtype=np.int64)
+        curr = np.full(n, ref_note, dtype=np.int64)
+        had_onset = np.ones(n, dtype=np.bool_)
+
+        for (bar, cp) in enumerate(cps):
+            # 이전 마디에 음이 없었으면 0 에서 출발.
+            curr = np.where(had_onset, curr, 0)
+            had_onset = np.zeros(n, dtype=np.bool_)
+            note_num_for_each_chord = division // len(cp)
+            usable_notes = scale.usable_notes
+
+            for idx in range(division):
+                cell = bar * division + idx
+                curr_chord = cp[idx // note_num_for_each_chord]
+                is_first_note_of_chord = idx % note_num_for_each_chord == 0
+
+                if (is_first_note_of_chord):
+                    chord_scale = scale if scale.has_chord(curr_chord) else Scale.estimate_scale(curr_chord)
+                    usable_notes = chord_scale.usable_notes
+
+                onset = patterns[:, cell]
+                if (not onset.any()):
+                    continue
+
+                prev = curr[onset]
+                u = uniforms[onset, cell]
+
+                if (is_first_note_of_chord):
+                    candidates = chord_melody_notes(curr_chord.chord)
+                    next_notes = candidates[step_indices(candidates, prev, std, u)]
+
+                    # 이전 음이 없으면 코드 구성음 중 아무거나 고름.
+                    is_rest = prev == 0
+                    random_idx = np.minimum((u[is_rest] * len(candidates)).astype(np.int64), len(candidates) - 1)
+                    next_notes[is_rest] = candidates[random_idx]
                 else:
-                    scale = Scale.estimate_scale(cp[nth_chord])
-
-                if (scale.scale is None):
-                    raise Exception('scale is empty')
+                    next_notes = usable_notes[step_indices(usable_notes, prev, std, u)]
 
-                usable_notes = list(scale.scale.intersection(Melody.limit))
+                curr[onset] = next_notes
+                pitches[onset, cell] = next_notes
+                had_onset |= onset
 
-            if (p == 0):
-                note_len += 1
-                continue
-
-            # 이전의 note를 append.
-            notes.append([
-                note_number,
-                note_len
-            ])
-
-            # 현재 note를 ref_note에 기반하여 계산
-            note_len = 1
-            if (is_first_note):
-                note_number = ref_note
-                is_first_note = False
-            
-            if (is_first_note_of_chord):
-                note_number = Melody._choose_from_chord(curr_chord, note_number, self.randomness)
-            else:
-                note_number = Melody._calc_next_note(
-                    note_number,
-                    usable_notes,
-                    self.randomness,
-                )
+        # 마디마다 첫 칸에 쉼표를 두고, onset 과 함께 시작 위치 순으로 정렬.
+        # 같은 칸이면 쉼표가 먼저 오고, 각 note 의 길이는 다음 note 까지의 거리.
+        bar_starts = np.arange(len(cps)) * division
+        notes_list = []
+        ref_notes = []
+        for m in range(n):
+            onsets = np.flatnonzero(patterns[m])
+            starts = np.concatenate((bar_starts, onsets))
+            pitch = np.concatenate((np.zeros(len(cps), dtype=np.int64), pitches[m, onsets]))
+            order = np.argsort(2*starts + (np.arange(len(starts)) >= len(cps)))
 
-        # 마지막 note 까지 append
-        notes.append([
-            note_number,
-            note_len
-        ])
+            notes = NoteArray.from_columns(pitch[order], np.diff(starts[order], append=cells), division)
+            notes_list.append(notes)
+            ref_notes.append(int(notes.pitch[-1]))
 
-        return notes
+        return (notes_list, ref_notes)
 
     def build_velocity(self):
         pass
@@ -285,50 +348,42 @@ class Melody():
             raise Exception('Empty notes')
         
         for (mel, dur) in self.notes:
-            if (random.uniform(0, 1) <= melody_randomness):
+            if (self.rng.random() <= melody_randomness):
                 res_melody.append([mel, dur])
             else:
                 # 현재 멜로디와 가장 가까운 음을 찾는다.
-                curr_mel_index = self.usable_notes.index(mel)
-                next_mel_index = Melody._calc_next_note(curr_mel_index, self.randomness, limit_len)
+                curr_mel_index = list(self.usable_notes).index(mel)
+                next_mel_index = Melody._calc_next_note(curr_mel_index, self.randomness, limit_len, self.rng)
                 next_mel = self.usable_notes[next_mel_index]
                 res_melody.append([next_mel, dur])
 
-        self.notes = res_melody
+        self.notes = NoteArray.from_pairs(res_melody, self.division)
 
     def get_differ_melody(self, melody_randomness, pattern_randomness=0):
         '''
         자신과 닮은 Melody 를 만든다.
         '''
-        notes = []
-
-        total_duration = 0
-
         if (self.notes is None):
             raise Exception('Empty notes')
 
-        for [note, dur] in self.notes:
+        cp = self.chord_progression.cp
+        steps_per_chord = (self.bar_length * self.division) // len(cp)
+        pitch = self.notes.pitch.copy()
 
-            if (note == 0) or (random.uniform(0, 1) > melody_randomness):
-                notes.append([note, dur])
-            else:
-                cp = self.chord_progression.cp
-                curr_chord = cp[total_duration // ((self.bar_length * self.division) // len(cp))]
-
-                scale = Scale.estimate_scale(curr_chord)
-
-                if (scale.scale is None):
-                    raise Exception('Scale estimation fault')
-                
-                usable_notes = list(scale.scale.intersection(Melody.limit)) 
-                note_number = Melody._calc_next_note(
-                    note,
-                    usable_notes,
-                    melody_randomness,
-                )
-                notes.append([note_number, dur])
-        
-            total_duration += dur
+        for (i, (note, start)) in enumerate(zip(pitch.tolist(), self.notes.start.tolist())):
+            if (note == 0) or (self.rng.random() > melody_randomness):
+                continue
+
+            curr_chord = cp[start // steps_per_chord]
+            usable_notes = Scale.estimate_scale(curr_chord).usable_notes
+            pitch[i] = Melody._calc_next_note(
+                note,
+                usable_notes,
+                melody_randomness,
+                self.rng,
+            )
+
+        notes = self.notes.with_pitch(pitch)
 
         return Melody(
             scale=self.scale,
@@ -340,23 +395,73 @@ class Melody():
             pattern=self.melody_pattern,
             notes=notes,
             velocity=self.velocity,
+            rng=self.rng,
         )
 
     @property
     def end_note(self):
         if (self.notes is not None):
-            return self.notes[-1][0]
+            return int(self.notes.pitch[-1])
         return 0
 
 
 def find_nearest(array, value):
-    array = np.array(array)
-    idx = (np.abs(array - value)).argmin()
+    '''
+    오름차순으로 정렬된 array 에서 value 와 가장 가까운 원소의 (index, 값).
+    거리가 같으면 작은 쪽을 반환.
+    '''
+    idx = int(np.searchsorted(array, value))
+    if (idx == len(array)) or (idx > 0 and value - array[idx - 1] <= array[idx] - value):
+        idx -= 1
     return (idx, array[idx])
 
 
+def nearest_indices(array, values) -> np.ndarray:
+    '''
+    find_nearest 의 배열 버전. values 각각에 대해 가장 가까운 원소의 index.
+    '''
+    idx = np.searchsorted(array, values)
+    lower = np.maximum(idx - 1, 0)
+    upper = np.minimum(idx, len(array) - 1)
+    use_lower = (idx == len(array)) | ((idx > 0) & (values - array[lower] <= array[upper] - values))
+    return np.where(use_lower, lower, upper)
+
+
+@functools.lru_cache(maxsize=256)
+def _step_cdf(std: float, size: int) -> np.ndarray:
+    '''
+    pivot 마다 floor(N(pivot, std)) 를 [0, size) 로 자른 분포의 누적 확률. (size, size + 1) 크기.
+    table[pivot, k] 는 k 보다 작은 index 가 뽑힐 확률.
+    '''
+    table = np.empty((size, size + 1))
+    for pivot in range(size):
+        dist = NormalDist(pivot, std)
+        cdf = np.array([dist.cdf(edge) for edge in range(size + 1)])
+        table[pivot] = (cdf - cdf[0]) / (cdf[-1] - cdf[0])
+    table.flags.writeable = False
+    return table
+
+
+def step_indices(array, values, std, u) -> np.ndarray:
+    '''
+    values 에서 가장 가까운 index 를 중심으로 floor(N(index, std)) 를 [0, len(array)) 안에서 뽑음.
+    범위를 벗어나면 다시 뽑는 것과 같은 분포지만, 균등 난수 u 하나로 역 CDF 를 계산하므로 반복하지 않음.
+    '''
+    table = _step_cdf(float(std), len(array))
+    pivots = nearest_indices(array, values)
+    return (table[pivots, 1:-1] <= np.asarray(u)[..., np.newaxis]).sum(axis=-1)
+
+
+def truncated_normal_index(mean, std, size, rng: np.random.Generator) -> int:
+    '''
+    floor(N(mean, std)) 를 [0, size) 안에서 뽑음. mean 은 index.
+    '''
+    table = _step_cdf(float(std), size)
+    return int((table[mean, 1:-1] <= rng.random()).sum())
+
+
 def printMelody(melody):
-    melody_main = np.array(melody.notes)[:, 0]
-    melody_dur = np.array(melody.notes)[:, 1]
+    melody_main = melody.notes.pitch
+    melody_dur = melody.notes.duration
 
-    print(np.vectorize(pretty_midi.note_number_to_name)(np.array(melody_main)), melody_dur)
+    print(np.vectorize(note_number_to_name)(np.array(melody_main)), melody_dur)
@@ -0,0 +1,168 @@
+from typing import Iterator, Sequence
+import numpy as np
+
+DEFAULT_VELOCITY = 100
+
+# note 하나의 정보. start 와 duration 은 division 단위의 칸 수.
+NOTE_DTYPE = np.dtype([
+    ('pitch', np.int16),
+    ('duration', np.int32),
+    ('velocity', np.uint8),
+    ('start', np.int32),
+])
+
+
+class NoteArray:
+    '''
+    note 들을 하나의 structured array 로 보관하는 container.
+
+    start 는 container 시작점으로부터의 칸 수이고, length 는 container 전체의 칸 수.
+    melody / chord 는 note 가 끊임없이 이어지므로 start 가 duration 의 누적합과 같고,
+    drum 은 같은 칸에 여러 note 가 있을 수 있음.
+    pitch 가 0 인 note 는 쉼표.
+    '''
+    __slots__ = ('events', 'division', 'length', 'is_drum')
+
+    def __init__(
+        self,
+        events: np.ndarray,
+        division: int,
+        length: int,
+        is_drum: bool = False,
+    ):
+        self.events = events
+        self.division = division
+        self.length = length
+        self.is_drum = is_drum
+
+    @staticmethod
+    def from_columns(
+        pitch: Sequence[int],
+        duration: Sequence[int],
+        division: int,
+        velocity: int = DEFAULT_VELOCITY,
+    ) -> 'NoteArray':
+        '''
+        이어지는 note 들의 pitch, duration 으로 만듦.
+        '''
+        duration = np.asarray(duration, dtype=np.int32)
+
+        events = np.empty(len(duration), dtype=NOTE_DTYPE)
+        events['pitch'] = pitch
+        events['duration'] = duration
+        events['velocity'] = velocity
+        events['start'][:1] = 0
+        np.cumsum(duration[:-1], out=events['start'][1:])
+
+        return NoteArray(events, division, int(duration.sum()))
+
+    @staticmethod
+    def from_pairs(
+        notes: Sequence[Sequence[int]],
+        division: int,
+        velocity: int = DEFAULT_VELOCITY,
+    ) -> 'NoteArray':
+        '''
+        [[pitch, duration], ...] 형태의 note 들로 만듦.
+        '''
+        pairs = np.asarray(notes, dtype=np.int32).reshape(-1, 2)
+        return NoteArray.from_columns(pairs[:, 0], pairs[:, 1], division, velocity)
+
+    @staticmethod
+    def from_drum(
+        pattern: np.ndarray,
+        division: int,
+        velocity: int = DEFAULT_VELOCITY,
+    ) -> 'NoteArray':
+        '''
+        (칸 수, 악기 수) 크기의 drum 패턴으로 만듦. 한 칸의 note 는 모두 한 칸 길이.
+        '''
+        (steps, voices) = pattern.shape
+
+        events = np.empty(steps * voices, dtype=NOTE_DTYPE)
+        events['pitch'] = pattern.ravel()
+        events['duration'] = 1
+        events['velocity'] = velocity
+        events['start'] = np.repeat(np.arange(steps), voices)
+
+        return NoteArray(events, division, steps, is_drum=True)
+
+    @staticmethod
+    def concat(arrays: Sequence['NoteArray']) -> 'NoteArray':
+        '''
+        여러 NoteArray 를 순서대로 이어 붙임. division 이 모두 같아야 함.
+        '''
+        first = arrays[0]
+        if any(array.division != first.division for array in arrays):
+            raise Exception('Division of notes must be same.')
+
+        lengths = np.array([array.length for array in arrays])
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        events = np.concatenate([array.events for array in arrays])
+        events['start'] += np.repeat(offsets, [len(array) for array in arrays]).astype(np.int32)
+
+        return NoteArray(events, first.division, int(lengths.sum()), first.is_drum)
+
+    def tile(self, count: int) -> 'NoteArray':
+        '''
+        자신을 count 번 반복한 NoteArray.
+        '''
+        events = np.tile(self.events, count)
+        events['start'] += np.repeat(np.arange(count, dtype=np.int32) * self.length, len(self))
+
+        return NoteArray(events, self.division, self.length * count, self.is_drum)
+
+    def with_pitch(self, pitch: Sequence[int]) -> 'NoteArray':
+        '''
+        리듬은 그대로 두고 pitch 만 바꾼 NoteArray.
+        '''
+        events = self.events.copy()
+        events['pitch'] = pitch
+        return NoteArray(events, self.division, self.length, self.is_drum)
+
+    def replace_tail(self, tail: 'NoteArray') -> 'NoteArray':
+        '''
+        마지막 tail.length 칸의 note 들을 tail 로 바꿈. ex) drum 패턴의 마지막 마디를 fill-in 으로.
+        '''
+        if tail.division != self.division:
+            raise Exception('Division of notes must be same.')
+
+        boundary = self.length - tail.length
+        head = self.events[self.events['start'] < boundary]
+        shifted = tail.events.copy()
+        shifted['start'] += boundary
+
+        return NoteArray(np.concatenate((head, shifted)), self.division, self.length, self.is_drum)
+
+    @property
+    def pitch(self) -> np.ndarray:
+        return self.events['pitch']
+
+    @property
+    def duration(self) -> np.ndarray:
+        return self.events['duration']
+
+    @property
+    def velocity(self) -> np.ndarray:
+        return self.events['velocity']
+
+    @property
+    def start(self) -> np.ndarray:
+        return self.events['start']
+
+    def to_pairs(self) -> list[list[int]]:
+        return np.stack((self.pitch, self.duration), axis=1).tolist()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        return zip(self.pitch.tolist(), self.duration.tolist())
+
+    def __getitem__(self, index: int) -> tuple[int, int]:
+        event = self.events[index]
+        return (int(event['pitch']), int(event['duration']))
+
+    def __str__(self):
+        return f'notes: {self.to_pairs()}\ndivision: {self.division}'
@@ -1,7 +1,14 @@
+import functools
 from typing import Union
 from pychord import Chord
-import pretty_midi
 import numpy as np
+from ..util.music.util import note_name_to_number
+
+# 멜로디가 올라갈 / 내려갈 수 있는 한계.
+MELODY_LIMIT = range(
+    note_name_to_number('E4'),
+    note_name_to_number('E6') + 1
+)
 
 class Scale:
     __notes_with_sharp = ['A', 'A#', 'B', 'C',
@@ -17,6 +24,7 @@ class Scale:
         mode
     ):
         self.root = root                    # 근음. ex) 'C'
+        self.pitch_class = Scale.pitch_class_of(root)   # 모드가 적용된 근음의 pitch class. C = 0
         self.default_scale = scale          # 스케일의 음 간격. ex) [0, 2, 4, 5, 7, 9, 11]
         self.scale: Union[set[int], None] = None                   # 실제 스케일의 음.
         self.mode = mode                    # 몇 번째 모드인지. 1 이면 원래 스케일과 동일.
@@ -25,20 +33,37 @@ class Scale:
 
     @staticmethod
     def estimate_scale(chord: Chord):
-        quality_string = str(chord.quality)
-        if (quality_string.isdigit()):
-            return MajorScale(chord.root, 5)        # Dominant 7
-        if ('m' in quality_string and 'b5' in quality_string):
-            return MajorScale(chord.root, 7)        # Half-diminished
-        if ('mM' in quality_string):
-            return MelodicMinorScale(chord.root)
-        if (quality_string == '' or 'M' in quality_string):
-            return MajorScale(chord.root)
-        if ('m' in quality_string):
-            return MajorScale(chord.root, 6)        # Natural minor
-        if ('dim' in quality_string):
-            return DiminishedScale(chord.root)
-        return AlteredScale(chord.root)
+        '''
+        코드에 어울리는 스케일을 추정.
+        같은 코드에 대해 항상 같은 Scale 객체를 반환하므로, 반환된 객체를 수정하면 안 됨.
+        '''
+        return _estimate_scale(chord.root, str(chord.quality))
+
+    @staticmethod
+    def pitch_class_of(note_name) -> int:
+        '''
+        음 이름의 pitch class. ex) 'C' -> 0, 'A' -> 9
+        '''
+        if (note_name in Scale.__notes_with_sharp):
+            idx = Scale.__notes_with_sharp.index(note_name)
+        else:
+            idx = Scale.__notes_with_flat.index(note_name)
+
+        return (idx + 9) % Scale.OCTAVE
+
+    @property
+    def usable_notes(self) -> np.ndarray:
+        '''
+        MELODY_LIMIT 안에 있는 스케일의 음. 오름차순으로 정렬된 읽기 전용 배열.
+        '''
+        key = (type(self), self.pitch_class, self.mode)
+        if (key in SCALE_TABLE):
+            return SCALE_TABLE[key]
+
+        if (self.scale is None):
+            raise Exception('scale is empty')
+
+        return np.array(sorted(self.scale.intersection(MELODY_LIMIT)))
 
     def build_scale(self, scale):
         # A4 = 440Hz. 높은 음자리표에 맞춤.
@@ -46,7 +71,7 @@ class Scale:
         if (self.mode != 1):
             self.root = self.unmoded_root()
 
-        root_as_number = pretty_midi.note_name_to_number(f'{self.root}4')
+        root_as_number = note_name_to_number(f'{self.root}4')
         weight = np.arange(-3, 5) * Scale.OCTAVE
         main_scale = np.array(scale)
         result_scale = []
@@ -113,13 +138,14 @@ class Scale:
 
 
 class MajorScale(Scale):
+    DEFAULT_SCALE = [0, 2, 4, 5, 7, 9, 11]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 2, 4, 5, 7, 9, 11]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, MajorScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Major'
 
     @property
@@ -130,77 +156,145 @@ class MajorScale(Scale):
 
 
 class MelodicMinorScale(Scale):
+    DEFAULT_SCALE = [0, 2, 3, 5, 7, 9, 11]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 2, 3, 5, 7, 9, 11]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, MelodicMinorScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Melodic minor'
 
 
 class PentatonicScale(Scale):
+    DEFAULT_SCALE = [0, 2, 4, 7, 9]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 2, 4, 7, 9]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, PentatonicScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Pentatonic'
 
 
 class BluesScale(Scale):
+    DEFAULT_SCALE = [0, 3, 5, 6, 7, 10]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 3, 5, 6, 7, 10]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, BluesScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Blues'
 
 
 class WholeToneScale(Scale):
+    DEFAULT_SCALE = [0, 2, 4, 6, 8, 10]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 2, 4, 6, 8, 10]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, WholeToneScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Whole tone'
 
 
 class ChromaticScale(Scale):
+    DEFAULT_SCALE = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, ChromaticScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Chromatic'
 
 
 class DiminishedScale(Scale):
+    DEFAULT_SCALE = [0, 1, 3, 4, 6, 7, 9, 10]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 1, 3, 4, 6, 7, 9, 10]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, DiminishedScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Diminished'
 
 
 class AlteredScale(Scale):
+    DEFAULT_SCALE = [0, 1, 3, 4, 6, 8, 10]
+
     def __init__(
             self,
             root,
             mode=1
     ):
-        default_scale = [0, 1, 3, 4, 6, 8, 10]
-        super().__init__(root, default_scale, mode)
+        super().__init__(root, AlteredScale.DEFAULT_SCALE, mode)
         self.scale_name = 'Altered'
+
+
+SCALE_CLASSES = [
+    MajorScale,
+    MelodicMinorScale,
+    PentatonicScale,
+    BluesScale,
+    WholeToneScale,
+    ChromaticScale,
+    DiminishedScale,
+    AlteredScale,
+]
+
+
+def _build_scale_table() -> dict[tuple[type, int, int], np.ndarray]:
+    '''
+    (스케일 종류, 근음의 pitch class, 모드) 마다 MELODY_LIMIT 안의 스케일 음을 미리 계산.
+    Scale.build_scale 과 같은 음을 Scale 객체를 만들지 않고 계산함.
+    '''
+    limit = np.arange(MELODY_LIMIT.start, MELODY_LIMIT.stop)
+    # [근음, 음] -> 근음에서 음까지의 pitch class 간격
+    distance = (limit[np.newaxis, :] - np.arange(Scale.OCTAVE)[:, np.newaxis]) % Scale.OCTAVE
+    table = {}
+
+    for scale_class in SCALE_CLASSES:
+        intervals = scale_class.DEFAULT_SCALE
+        in_scale = np.zeros(Scale.OCTAVE, dtype=np.bool_)
+        in_scale[intervals] = True
+        # 근음마다 MELODY_LIMIT 안의 스케일 음. 모드는 근음만 바꾸므로 한 번만 계산.
+        notes_by_root = []
+        for mask in in_scale[distance]:
+            notes = limit[mask]
+            notes.flags.writeable = False
+            notes_by_root.append(notes)
+
+        for mode in range(1, len(intervals) + 1):
+            for pitch_class in range(Scale.OCTAVE):
+                unmoded_root = (pitch_class - intervals[mode - 1]) % Scale.OCTAVE
+                table[(scale_class, pitch_class, mode)] = notes_by_root[unmoded_root]
+
+    return table
+
+
+SCALE_TABLE = _build_scale_table()
+
+
+@functools.lru_cache(maxsize=None)
+def _estimate_scale(root: str, quality_string: str) -> Scale:
+    if (quality_string.isdigit()):
+        return MajorScale(root, 5)        # Dominant 7
+    if ('m' in quality_string and 'b5' in quality_string):
+        return MajorScale(root, 7)        # Half-diminished
+    if ('mM' in quality_string):
+        return MelodicMinorScale(root)
+    if (quality_string == '' or 'M' in quality_string):
+        return MajorScale(root)
+    if ('m' in quality_string):
+        return MajorScale(root, 6)        # Natural minor
+    if ('dim' in quality_string):
+        return DiminishedScale(root)
+    return AlteredScale(root)
@@ -0,0 +1,63 @@
+from typing import Sequence
+import numpy as np
+from .note import NoteArray
+
+TICKS_PER_BEAT = 480            # 4분음표 하나의 tick 수. 16분음표, 셋잇단음표까지 정수로 나누어 떨어짐.
+TICKS_PER_BAR = 4 * TICKS_PER_BEAT
+
+# 곡 전체에서의 note 하나. start, end 는 곡 시작점으로부터의 tick.
+EVENT_DTYPE = np.dtype([
+    ('pitch', np.uint8),
+    ('velocity', np.uint8),
+    ('start', np.int64),
+    ('end', np.int64),
+])
+
+
+def step_ticks(division: int) -> int:
+    '''
+    한 마디를 division 칸으로 나눴을 때 한 칸의 tick 수.
+    '''
+    if TICKS_PER_BAR % division != 0:
+        raise Exception(f'Division {division} does not fit in the tick grid.')
+    return TICKS_PER_BAR // division
+
+
+def part_ticks(part: Sequence[NoteArray]) -> int:
+    '''
+    part 의 길이 (tick). 가장 긴 악기의 길이.
+    '''
+    return max(notes.length * step_ticks(notes.division) for notes in part)
+
+
+def build_timeline(part_list: Sequence[Sequence[NoteArray]]) -> list[np.ndarray]:
+    '''
+    part 들을 순서대로 이어 붙여, 악기 자리마다 곡 전체의 note 를 EVENT_DTYPE 배열로 만듦.
+
+    part 의 길이는 가장 긴 악기의 길이이고, part 의 시작 tick 은 앞선 part 길이의 누적합.
+    모든 위치를 정수 tick 으로 계산하므로 곡이 길어져도 오차가 쌓이지 않음.
+    pitch 가 0 인 note (쉼표, 치지 않는 drum) 는 제외함.
+    '''
+    tracks = len(part_list[0])
+    for part in part_list:
+        if len(part) != tracks:
+            raise Exception(f'Must contain {tracks} instruments.')
+
+    lengths = np.array([part_ticks(part) for part in part_list])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    timeline = []
+    for track in range(tracks):
+        parts = [part[track] for part in part_list]
+        ticks = np.repeat([step_ticks(notes.division) for notes in parts], [len(notes) for notes in parts])
+        notes = np.concatenate([notes.events for notes in parts])
+
+        events = np.empty(len(notes), dtype=EVENT_DTYPE)
+        events['pitch'] = notes['pitch']
+        events['velocity'] = notes['velocity']
+        events['start'] = notes['start'] * ticks + np.repeat(offsets, [len(notes) for notes in parts])
+        events['end'] = events['start'] + notes['duration'] * ticks
+
+        timeline.append(events[events['pitch'] > 0])
+
+    return timeline
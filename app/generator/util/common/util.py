@@ -1,3 +1,7 @@
+import time
+from contextlib import contextmanager
+from typing import Union
+
 def divide_chunk(list_dividend, division_size):
     list_dividend = list(list_dividend)
     def __divide_chunk(l, n):
@@ -15,3 +19,25 @@ def divide_chunk_into(list_dividend, num):
         division_size += 1
 
     return divide_chunk(list_dividend, division_size)
+
+def choice(sequence, rng):
+    '''
+    sequence 에서 rng 로 원소 하나를 선택.
+    rng.choice 는 길이가 다른 tuple 들의 list 를 배열로 바꾸지 못하므로 index 로 선택.
+    '''
+    return sequence[rng.integers(len(sequence))]
+
+@contextmanager
+def timed(spans: Union[list, None], stage: str):
+    '''
+    with 안의 소요 시간 (초) 을 spans 에 (stage, 초) 로 추가. spans 가 None 이면 재지 않음.
+    '''
+    if spans is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((stage, time.perf_counter() - start))
@@ -31,3 +31,26 @@ def get_transposed_cp(cp: ChordProgression, amount: int):
 
 def calc_scale_from_chord(original_scale, chord):
     pass
+
+_NOTE_OFFSETS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_ACCIDENTAL_OFFSETS = {'#': 1, 'b': -1, '!': -1}
+_NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def note_name_to_number(note_name: str) -> int:
+    '''
+    음 이름을 midi number 로 변환. pretty_midi 와 같은 규칙. ex) 'C4' -> 60, 'Bb2' -> 46
+    '''
+    idx = 1
+    offset = _NOTE_OFFSETS[note_name[0].upper()]
+    while (note_name[idx] in _ACCIDENTAL_OFFSETS):
+        offset += _ACCIDENTAL_OFFSETS[note_name[idx]]
+        idx += 1
+
+    return offset + (int(note_name[idx:]) + 1) * 12
+
+def note_number_to_name(note_number: int) -> str:
+    '''
+    midi number 를 음 이름으로 변환. ex) 61 -> 'C#4'
+    '''
+    note_number = int(note_number)
+    return f'{_NOTE_NAMES[note_number % 12]}{note_number // 12 - 1}'
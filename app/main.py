@@ -1,28 +1,222 @@
 import asyncio
 import logging
 import traceback
-from typing import Literal
-from fastapi import FastAPI, BackgroundTasks, Request, Response
-from pydantic import BaseModel
-from fastapi.responses import FileResponse, JSONResponse
+from contextlib import asynccontextmanager
+import json
+import secrets
+import zipfile
+from itertools import product
+from typing import Literal, Union, get_args
+from fastapi import FastAPI, Path, Request, Response
+from pydantic import BaseModel, Field
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.background import BackgroundTask
 from starlette.types import ASGIApp
-from app.generator import generator
-from app.util import convert
+from app import generator
+from app.util import metrics
+from app.util.engine import GenerationEngine, EngineBusyError
+from app.util.render import RenderFarm, RenderBusyError
+from app.util.cache import RenderCache
+from app.util.formats import DEFAULT_FORMAT, FORMATS, negotiate
+from app.util.pool import SongPool
+from app.util.song import SongEditor
+from app.util.janitor import Janitor
+from app.util.jobs import Job, JobQueue, JobQueueFullError, QUEUED, COMPOSING, RENDERING, DONE
 from app.util.logger import CustomFormatter
+from app.util.profiler import Profiler, PROFILE_NAME_PATTERN, run_profiled
 import uuid
-from concurrent.futures import ThreadPoolExecutor
 import os
 
+assets_dir_path = './app/assets/'
+music_dir_path = assets_dir_path + 'music/'
+soundfont_path = assets_dir_path + 'soundfont.sf2'
+
+Genre = Literal['newage', 'retro']
+Mood = Literal['happy', 'sad', 'grand']
+Tempo = Literal['slow', 'moderate', 'fast']
+Format = Literal['mp3', 'mp3-128', 'mp3-320', 'opus', 'aac', 'preview', 'midi']
+
 class MusicBody(BaseModel):
-    genre: Literal['newage', 'retro']
-    mood: Literal['happy', 'sad', 'grand']
-    tempo: Literal['slow', 'moderate', 'fast']
+    genre: Genre
+    mood: Mood
+    tempo: Tempo
+    bpm: Union[int, None] = Field(default=None, ge=40, le=240)
+    seed: Union[int, None] = Field(default=None, ge=0, lt=2**63)
+    # 없으면 Accept header 로 정함.
+    format: Union[Format, None] = None
+
+BATCH_MAX_SONGS = int(os.environ.get('BATCH_MAX_SONGS', 100))
+
+class BatchBody(BaseModel):
+    songs: list[MusicBody] = Field(min_length=1, max_length=BATCH_MAX_SONGS)
+
+class SectionBody(BaseModel):
+    seed: Union[int, None] = Field(default=None, ge=0, lt=2**63)
+
+class SongEditBody(BaseModel):
+    bpm: int = Field(ge=40, le=240)
+
+engine = GenerationEngine(initializer=generator.preload)
+render_farm = RenderFarm(soundfont=soundfont_path)
+render_cache = RenderCache()
+# 같은 곡도 형식마다 따로 저장. 기본 형식이 아닌 것은 render cache 디렉토리 아래 형식 이름의 디렉토리에.
+render_caches = {
+    name: render_cache if name == DEFAULT_FORMAT else RenderCache(
+        cache_dir=os.path.join(render_cache.cache_dir, name),
+        extension=output_format.extension,
+    )
+    for (name, output_format) in FORMATS.items()
+}
+# 렌더링은 RENDER_TIMEOUT 안에 끝나므로 그보다 오래된 임시 파일만 시작할 때 삭제.
+janitor = Janitor(
+    music_dir=music_dir_path,
+    render_caches=list(render_caches.values()),
+    startup_age=render_farm.timeout,
+)
+profiler = Profiler()
+song_editor = SongEditor(
+    engine=engine,
+    render_farm=render_farm,
+    render_caches=render_caches,
+    work_dir=music_dir_path,
+)
+song_pool = SongPool(
+    engine=engine,
+    render_farm=render_farm,
+    buckets=list(product(get_args(Genre), get_args(Mood), get_args(Tempo))),
+)
+
+def song_cache_key(music_body: MusicBody, seed: int, stream: bool = False) -> str:
+    '''
+    stream 은 곡 전체를 한 번에 합성하므로 section 별로 합성해 합친 음원과 조금 다름.
+    같은 seed 와 방식으로 요청하면 항상 같은 음원을 받도록 stream 으로 만든 음원은 따로 저장.
+    '''
+    params = dict(
+        genre=music_body.genre,
+        mood=music_body.mood,
+        tempo=music_body.tempo,
+        bpm=music_body.bpm,
+        seed=seed,
+        soundfont=render_farm.soundfont_hash,
+        composer=generator.COMPOSER_VERSION,
+    )
+    if stream:
+        params['stream'] = True
+    return RenderCache.make_key(**params)
+
+async def compose(fn, music_body: MusicBody, seed: int, profile_id: Union[str, None] = None):
+    '''
+    generation engine 에서 fn 으로 곡을 만들어 결과를 반환하고, 단계별 소요 시간을 기록.
+    fn 은 (결과, spans) 를 반환하는 generator.compose_parts_timed 나 generator.make_song_timed.
+    profile_id 가 주어지면 작곡을 cProfile 로 실행하고 결과를 저장.
+    '''
+    kwargs = dict(
+        genre=music_body.genre,
+        mood=music_body.mood,
+        tempo=music_body.tempo,
+        bpm=music_body.bpm,
+        seed=seed,
+    )
+
+    profile_path = profiler.path(profile_id, 'compose')
+    if profile_path is not None:
+        (result, spans) = await engine.run(run_profiled, profile_path, fn, **kwargs)
+    else:
+        (result, spans) = await engine.run(fn, **kwargs)
+
+    metrics.observe(spans)
+    return result
+
+async def produce_song(music_body: MusicBody, seed: int, set_state=None) -> str:
+    '''
+    곡을 music_body.format 형식으로 만들어 그 형식의 cache 에 저장하고 cache key 를 반환.
+    대기열에서 이미 기다린 작업 (job, batch) 에서 사용하므로
+    engine / render farm 이 바쁘면 실패하지 않고 Retry-After 만큼 기다린 뒤 다시 시도.
+    '''
+    output_format = FORMATS[music_body.format or DEFAULT_FORMAT]
+    format_cache = render_caches[output_format.name]
+    cache_key = song_cache_key(music_body, seed)
+    if format_cache.get(cache_key) is not None:
+        return cache_key
+
+    profile_id = profiler.sample()
+
+    if set_state is not None:
+        set_state(COMPOSING)
+    while True:
+        try:
+            composition = await compose(
+                generator.compose_parts_timed if output_format.rendered else generator.make_song_timed,
+                music_body,
+                seed,
+                profile_id,
+            )
+            break
+        except EngineBusyError as e:
+            await asyncio.sleep(e.retry_after)
+
+    # midi 는 렌더링하지 않음.
+    if not output_format.rendered:
+        format_cache.put_bytes(cache_key, composition)
+        return cache_key
 
-app = FastAPI()
+    if set_state is not None:
+        set_state(RENDERING)
+    audio_file = music_dir_path + f'{uuid.uuid1()}.{output_format.extension}'
+    while True:
+        try:
+            await render_farm.render_parts(
+                composition, audio_file, profiler.path(profile_id, 'render'), output_format,
+            )
+            break
+        except RenderBusyError as e:
+            await asyncio.sleep(e.retry_after)
 
-executor = ThreadPoolExecutor(max_workers=1)
+    format_cache.put_file(cache_key, audio_file)
+    return cache_key
+
+async def run_job(job: Job, set_state) -> str:
+    return await produce_song(MusicBody(**job.params), job.params['seed'], set_state)
+
+job_queue = JobQueue(runner=run_job)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(music_dir_path, exist_ok=True)
+    janitor.start()
+    profiler.start()
+    for format_cache in render_caches.values():
+        format_cache.load()
+    song_editor.load()
+    engine.start()
+    render_farm.start()
+    song_pool.load()
+    song_pool.start()
+    job_queue.start()
+    yield
+    await job_queue.shutdown()
+    await song_pool.shutdown()
+    await janitor.shutdown()
+    render_farm.shutdown()
+    engine.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.TimingMiddleware, paths=('/music', '/jobs', '/songs'))
+
+metrics.track(metrics.GENERATION_IN_FLIGHT, lambda: engine.in_flight)
+metrics.track(metrics.GENERATION_QUEUE_DEPTH, lambda: engine.queue_depth)
+metrics.track(metrics.RENDER_IN_FLIGHT, lambda: render_farm.in_flight)
+metrics.track(metrics.RENDER_QUEUE_DEPTH, lambda: render_farm.queue_depth)
+metrics.track(metrics.JOB_QUEUE_DEPTH, lambda: job_queue.queue_depth)
+for bucket in song_pool.buckets:
+    metrics.track(metrics.POOL_DEPTH, lambda bucket=bucket: song_pool.depth(bucket), bucket=SongPool.bucket_name(bucket))
+    metrics.track(
+        metrics.POOL_REFILL_LAG,
+        lambda bucket=bucket: song_pool.refill_lag(bucket),
+        bucket=SongPool.bucket_name(bucket),
+    )
 
 logger = logging.getLogger("main")
 logger.setLevel(logging.DEBUG)
@@ -30,48 +224,123 @@ ch = logging.StreamHandler()
 ch.setFormatter(CustomFormatter())
 logger.addHandler(ch)
 
-assets_dir_path = './app/assets/'
-music_dir_path = assets_dir_path + 'music/'
-
-async def delete_music_file(music_uuid: str):
-    global music_dir_path
-
-    midi_file = music_dir_path + f'{music_uuid}.mid'
-    mp3_file = music_dir_path + f'{music_uuid}.mp3'
-
-    timeout = 100
-
+async def cache_stream(stream, format_cache: RenderCache, cache_key: str):
+    '''
+    stream 을 그대로 전달하면서, 끝까지 성공하면 결과를 format_cache 에 저장.
+    '''
+    chunks = []
     try:
-        await asyncio.sleep(timeout)
-        os.remove(midi_file)
-        os.remove(mp3_file)
-        print(f'deleted {music_uuid}.mid, {music_uuid}.mp3')
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
     except Exception as e:
+        # 이미 응답이 시작되었으므로 연결을 끊는 것 외에는 알릴 방법이 없음.
         logger.error(e)
         logger.info(traceback.format_exc())
+        raise
+    finally:
+        # client 가 연결을 끊어 중간에 닫혀도 렌더링을 멈추고 slot 을 돌려줌.
+        await stream.aclose()
+
+    format_cache.put_bytes(cache_key, b''.join(chunks))
 
-        print('failed to remove')
+@app.get('/health', status_code=200)
+async def health():
+    return {
+        'status': 'ok',
+        'generation_in_flight': engine.in_flight,
+        'generation_queue_depth': engine.queue_depth,
+        'render_in_flight': render_farm.in_flight,
+        'render_queue_depth': render_farm.queue_depth,
+        'cache_entries': sum(len(format_cache) for format_cache in render_caches.values()),
+        'cache_bytes': sum(format_cache.total_bytes for format_cache in render_caches.values()),
+        'job_queue_depth': job_queue.queue_depth,
+        **janitor.stats(),
+    }
+
+@app.get('/metrics', status_code=200)
+async def get_metrics():
+    (data, content_type) = metrics.latest()
+    return Response(data, media_type=content_type)
+
+@app.get('/pool', status_code=200)
+async def pool_stats():
+    return song_pool.stats()
 
 @app.post('/music', status_code=200)
-async def get_music(music_body: MusicBody, background_tasks: BackgroundTasks):
+async def get_music(request: Request, music_body: MusicBody, stream: bool = False):
+    '''
+    곡을 만들어 music_body.format, 없으면 Accept header 로 정한 형식으로 반환.
+    midi 는 렌더링하지 않고 작곡한 midi 를 그대로 반환.
+    '''
+    metrics.observe_since('validation', request.state.received_at)
+    output_format = negotiate(music_body.format, request.headers.get('Accept'))
+    format_cache = render_caches[output_format.name]
     uuid_prefix = str(uuid.uuid1())
-    midi_file = music_dir_path + f'{uuid_prefix}.mid'
-    mp3_file = music_dir_path + f'{uuid_prefix}.mp3'
-    soundfont_path = assets_dir_path + 'soundfont.sf2'
+    audio_file = music_dir_path + f'{uuid_prefix}.{output_format.extension}'
 
     header = {
         'isSuccess': 'true',
         'code': '200',
         'message': '',
+        'format': output_format.name,
+        'Vary': 'Accept',
     }
 
+    # 특정 곡을 요청한 것이 아니면 미리 만들어 둔 곡을 바로 제공.
+    # 꺼낸 곡은 cache 로 옮겨서 같은 seed 로 다시 요청할 수 있게 함.
+    # 미리 만들어 두는 곡은 기본 형식뿐임.
+    if music_body.seed is None and music_body.bpm is None and output_format.name == DEFAULT_FORMAT:
+        pooled_song = song_pool.pop(music_body.genre, music_body.mood, music_body.tempo)
+        pooled_file = None
+        if pooled_song is not None:
+            try:
+                pooled_file = render_cache.put_file(song_cache_key(music_body, pooled_song.seed), pooled_song.path)
+            except OSError as e:
+                # 곡 파일이 사라졌거나 옮길 수 없으면 새로 만듦.
+                logger.warning(f'pooled song is unavailable: {e}')
+
+        if pooled_file is not None:
+            header['message'] = 'music generation success'
+            header['seed'] = str(pooled_song.seed)
+            return FileResponse(pooled_file, media_type=output_format.media_type, headers=header)
+
+    # seed 가 없으면 새로 정해서 돌려줌. 같은 seed 로 다시 요청하면 같은 곡을 받을 수 있음.
+    seed = music_body.seed if music_body.seed is not None else secrets.randbits(63)
+    header['seed'] = str(seed)
+
+    # midi 는 렌더링하지 않으므로 stream 이어도 같음.
+    cache_key = song_cache_key(music_body, seed, stream and output_format.rendered)
+    cached_file = format_cache.get(cache_key)
+    if cached_file is not None:
+        header['message'] = 'music generation success'
+        return FileResponse(cached_file, media_type=output_format.media_type, headers=header)
+
+    # X-Profile header 가 있거나 sampling 된 요청은 profile 하고, 나중에 찾을 수 있도록 id 를 돌려줌.
+    profile_id = profiler.sample(request.headers.get('X-Profile'))
+    if profile_id is not None:
+        header['profile'] = profile_id
+
+    # stream 은 처음부터 차례대로 인코딩해야 하므로 곡 전체를 한 midi 로,
+    # 나머지는 section 마다 한 번씩만 합성할 수 있도록 section 별 midi 로 만듦.
+    # midi 형식은 렌더링하지 않으므로 곡 전체를 한 midi 로 만듦.
     try:
-        generator.make_song(
-            genre=music_body.genre,
-            mood=music_body.mood,
-            tempo=music_body.tempo,
-            music_path=midi_file,
+        whole_song = stream or not output_format.rendered
+        composition = await compose(
+            generator.make_song_timed if whole_song else generator.compose_parts_timed,
+            music_body,
+            seed,
+            profile_id,
         )
+    except EngineBusyError as e:
+        header['isSuccess'] = 'false'
+        header['code'] = '503'
+        header['message'] = 'music generation busy'
+        header['Retry-After'] = str(e.retry_after)
+
+        logger.warning(e)
+
+        return JSONResponse('', status_code=503, headers=header)
     except Exception as e:
         header['isSuccess'] = 'false'
         header['code'] = '500'
@@ -82,11 +351,46 @@ async def get_music(music_body: MusicBody, background_tasks: BackgroundTasks):
 
         # 비어있는 파일을 반환
         return JSONResponse('', headers=header)
-    
+
+    if not output_format.rendered:
+        header['message'] = 'music generation success'
+
+        midi_file = format_cache.put_bytes(cache_key, composition)
+
+        return FileResponse(midi_file, media_type=output_format.media_type, headers=header)
+
+    if stream:
+        try:
+            audio_stream = await render_farm.stream(composition, output_format)
+        except RenderBusyError as e:
+            header['isSuccess'] = 'false'
+            header['code'] = '503'
+            header['message'] = 'music rendering busy'
+            header['Retry-After'] = str(e.retry_after)
+
+            logger.warning(e)
+
+            return JSONResponse('', status_code=503, headers=header)
+
+        header['message'] = 'music generation success'
+
+        return StreamingResponse(
+            cache_stream(audio_stream, format_cache, cache_key),
+            media_type=output_format.media_type,
+            headers=header,
+        )
+
     try:
-        future = executor.submit(convert.midi_to_mp3, midi_file, soundfont_path, mp3_file)
-        future.result()
+        await render_farm.render_parts(composition, audio_file, profiler.path(profile_id, 'render'), output_format)
+    except RenderBusyError as e:
+        header['isSuccess'] = 'false'
+        header['code'] = '503'
+        header['message'] = 'music rendering busy'
+        header['Retry-After'] = str(e.retry_after)
+
+        logger.warning(e)
 
+        return JSONResponse('', status_code=503, headers=header)
     except Exception as e:
         header['isSuccess'] = 'false'
         header['code'] = '500'
@@ -100,6 +404,303 @@ async def get_music(music_body: MusicBody, background_tasks: BackgroundTasks):
 
     header['message'] = 'music generation success'
 
-    background_tasks.add_task(delete_music_file, uuid_prefix)
+    audio_file = format_cache.put_file(cache_key, audio_file)
+
+    return FileResponse(audio_file, media_type=output_format.media_type, headers=header)
+
+async def produce_batch(songs: list[MusicBody]):
+    '''
+    곡들을 generation / render pool 에 나누어 만들고, 끝나는 순서대로 결과를 yield.
+    두 pool 이 모두 쉬지 않도록 pool 크기의 합만큼 동시에 진행.
+    '''
+    semaphore = asyncio.Semaphore(engine.max_workers + render_farm.slots)
+
+    async def produce(index: int, music_body: MusicBody) -> dict:
+        seed = music_body.seed if music_body.seed is not None else secrets.randbits(63)
+        item = {
+            'index': index,
+            **music_body.model_dump(),
+            'seed': seed,
+            'format': music_body.format or DEFAULT_FORMAT,
+        }
+
+        async with semaphore:
+            try:
+                item['key'] = await produce_song(music_body, seed)
+            except Exception as e:
+                logger.error(e)
+                logger.info(traceback.format_exc())
+                item['error'] = str(e)
+
+        return item
+
+    tasks = [asyncio.create_task(produce(index, music_body)) for (index, music_body) in enumerate(songs)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # client 가 연결을 끊으면 남은 작업을 취소.
+        for task in tasks:
+            task.cancel()
+
+def write_batch_zip(zip_file: str, items: list[dict]):
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for item in items:
+            if 'key' not in item:
+                continue
+
+            audio_file = render_caches[item['format']].get(item['key'])
+            if audio_file is None:
+                item['error'] = 'music expired'
+                continue
+
+            extension = FORMATS[item['format']].extension
+            item['file'] = f"{item['index']:04d}_{item['genre']}_{item['mood']}_{item['tempo']}_{item['seed']}.{extension}"
+            zf.write(audio_file, item['file'])
+
+        zf.writestr('manifest.json', json.dumps(items, indent=2))
+
+@app.post('/music/batch', status_code=200)
+async def get_music_batch(request: Request, batch_body: BatchBody, format: Literal['zip', 'ndjson'] = 'zip'):
+    '''
+    여러 곡을 한 번에 생성.
+    zip 은 모든 곡과 manifest.json 을 담은 파일을,
+    ndjson 은 곡이 완성되는 대로 한 줄씩 결과와 다운로드 url 을 반환.
+    '''
+    metrics.observe_since('validation', request.state.received_at)
+
+    if format == 'ndjson':
+        async def manifest():
+            async for item in produce_batch(batch_body.songs):
+                if 'key' in item:
+                    item['url'] = f"/music/{item['key']}"
+                    if item['format'] != DEFAULT_FORMAT:
+                        item['url'] += f"?format={item['format']}"
+                yield json.dumps(item) + '\n'
+
+        return StreamingResponse(manifest(), media_type='application/x-ndjson')
 
-    return FileResponse(mp3_file, headers=header)
+    items = [item async for item in produce_batch(batch_body.songs)]
+    items.sort(key=lambda item: item['index'])
+
+    zip_file = music_dir_path + f'{uuid.uuid1()}.zip'
+    await asyncio.to_thread(write_batch_zip, zip_file, items)
+
+    return FileResponse(
+        zip_file,
+        media_type='application/zip',
+        filename='music.zip',
+        background=BackgroundTask(os.remove, zip_file),
+    )
+
+@app.get('/music/{cache_key}', status_code=200)
+async def get_cached_music(
+    request: Request,
+    cache_key: str = Path(pattern='^[0-9a-f]{64}$'),
+    format: Union[Format, None] = None,
+):
+    output_format = negotiate(format, request.headers.get('Accept'))
+    audio_file = render_caches[output_format.name].get(cache_key)
+    if audio_file is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'music not found'))
+
+    header = {
+        'isSuccess': 'true',
+        'code': '200',
+        'message': 'music generation success',
+        'format': output_format.name,
+        'Vary': 'Accept',
+    }
+    return FileResponse(audio_file, media_type=output_format.media_type, headers=header)
+
+def job_response(job: Job) -> dict:
+    res = job.to_dict()
+    res['position'] = job_queue.position(job.id) if job.state == QUEUED else 0
+    return res
+
+def fail_header(code: int, message: str) -> dict:
+    return {
+        'isSuccess': 'false',
+        'code': str(code),
+        'message': message,
+    }
+
+@app.post('/jobs', status_code=202)
+async def submit_job(request: Request, music_body: MusicBody):
+    metrics.observe_since('validation', request.state.received_at)
+    params = music_body.model_dump()
+    # 결과를 다시 받을 수 있도록 seed 와 형식을 미리 정함.
+    if params['seed'] is None:
+        params['seed'] = secrets.randbits(63)
+    params['format'] = negotiate(music_body.format, request.headers.get('Accept')).name
+
+    try:
+        job = job_queue.submit(params)
+    except JobQueueFullError as e:
+        header = fail_header(503, 'job queue is full')
+        header['Retry-After'] = str(e.retry_after)
+
+        logger.warning(e)
+
+        return JSONResponse('', status_code=503, headers=header)
+
+    return job_response(job)
+
+@app.get('/jobs/{job_id}', status_code=200)
+async def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'job not found'))
+
+    return job_response(job)
+
+@app.get('/jobs/{job_id}/audio', status_code=200)
+async def get_job_audio(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'job not found'))
+
+    if job.state != DONE or job.result is None:
+        return JSONResponse('', status_code=409, headers=fail_header(409, f'job is {job.state}'))
+
+    output_format = FORMATS[job.params.get('format') or DEFAULT_FORMAT]
+    audio_file = render_caches[output_format.name].get(job.result)
+    if audio_file is None:
+        return JSONResponse('', status_code=410, headers=fail_header(410, 'music expired'))
+
+    header = {
+        'isSuccess': 'true',
+        'code': '200',
+        'message': 'music generation success',
+        'seed': str(job.params['seed']),
+        'format': output_format.name,
+    }
+    return FileResponse(audio_file, media_type=output_format.media_type, headers=header)
+
+@app.get('/profiles', status_code=200)
+async def list_profiles(request: Request):
+    if not profiler.authorized(request.headers.get('X-Profile')):
+        return JSONResponse('', status_code=403, headers=fail_header(403, 'profile access denied'))
+
+    profiles = profiler.list()
+    return {**profiler.stats(), 'profiles': profiles}
+
+@app.get('/profiles/{name}', status_code=200)
+async def get_profile(request: Request, name: str = Path(pattern=PROFILE_NAME_PATTERN)):
+    if not profiler.authorized(request.headers.get('X-Profile')):
+        return JSONResponse('', status_code=403, headers=fail_header(403, 'profile access denied'))
+
+    profile_file = profiler.get(name)
+    if profile_file is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'profile not found'))
+
+    return FileResponse(profile_file, media_type='application/octet-stream', filename=name)
+
+def edit_fail_response(e: Exception, message: str) -> JSONResponse:
+    '''
+    곡 편집 중 발생한 오류를 응답으로 변환.
+    '''
+    if isinstance(e, (EngineBusyError, RenderBusyError)):
+        header = fail_header(503, f'{message} busy')
+        header['Retry-After'] = str(e.retry_after)
+
+        logger.warning(e)
+
+        return JSONResponse('', status_code=503, headers=header)
+
+    logger.error(e)
+    logger.info(traceback.format_exc())
+
+    return JSONResponse('', status_code=500, headers=fail_header(500, f'{message} fail'))
+
+@app.post('/songs', status_code=201)
+async def create_song(request: Request, music_body: MusicBody):
+    '''
+    편집할 수 있는 곡을 만듦. 음원은 /songs/{song_id}/audio 에서 받음.
+    '''
+    metrics.observe_since('validation', request.state.received_at)
+
+    # 형식은 음원을 받을 때 정함.
+    params = music_body.model_dump(exclude={'format'})
+    if params['seed'] is None:
+        params['seed'] = secrets.randbits(63)
+
+    try:
+        song = await song_editor.create(params)
+    except Exception as e:
+        return edit_fail_response(e, 'music generation')
+
+    return song.to_dict()
+
+@app.get('/songs/{song_id}', status_code=200)
+async def get_song(song_id: str):
+    song = song_editor.get(song_id)
+    if song is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'song not found'))
+
+    return song.to_dict()
+
+@app.post('/songs/{song_id}/sections/{section}', status_code=200)
+async def regenerate_section(request: Request, song_id: str, section: str, section_body: SectionBody):
+    '''
+    section 하나를 다시 만듦. seed 가 없으면 새로 정함.
+    '''
+    metrics.observe_since('validation', request.state.received_at)
+
+    song = song_editor.get(song_id)
+    if song is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'song not found'))
+    if section not in song.parts:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'section not found'))
+
+    seed = section_body.seed if section_body.seed is not None else secrets.randbits(63)
+    try:
+        changed = await song_editor.regenerate(song, section, seed)
+    except Exception as e:
+        return edit_fail_response(e, 'music generation')
+
+    return {**song.to_dict(), 'changed': changed}
+
+@app.patch('/songs/{song_id}', status_code=200)
+async def edit_song(request: Request, song_id: str, edit_body: SongEditBody):
+    '''
+    곡은 그대로 두고 bpm 을 바꿈.
+    '''
+    metrics.observe_since('validation', request.state.received_at)
+
+    song = song_editor.get(song_id)
+    if song is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'song not found'))
+
+    try:
+        changed = await song_editor.set_bpm(song, edit_body.bpm)
+    except Exception as e:
+        return edit_fail_response(e, 'music generation')
+
+    return {**song.to_dict(), 'changed': changed}
+
+@app.get('/songs/{song_id}/audio', status_code=200)
+async def get_song_audio(request: Request, song_id: str, format: Union[Format, None] = None):
+    '''
+    곡의 음원을 format, 없으면 Accept header 로 정한 형식으로 반환.
+    편집 후에는 바뀐 section 만 다시 렌더링함.
+    '''
+    song = song_editor.get(song_id)
+    if song is None:
+        return JSONResponse('', status_code=404, headers=fail_header(404, 'song not found'))
+
+    output_format = negotiate(format, request.headers.get('Accept'))
+    try:
+        audio_file = await song_editor.audio(song, output_format)
+    except Exception as e:
+        return edit_fail_response(e, 'music rendering')
+
+    header = {
+        'isSuccess': 'true',
+        'code': '200',
+        'message': 'music generation success',
+        'seed': str(song.params['seed']),
+        'format': output_format.name,
+        'Vary': 'Accept',
+    }
+    return FileResponse(audio_file, media_type=output_format.media_type, headers=header)
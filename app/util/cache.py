@@ -0,0 +1,184 @@
+import os
+import time
+import shutil
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Union
+
+
+def file_hash(path: str, chunk_size: int = 1024 * 1024) -> str:
+    '''
+    파일 내용의 sha256. 파일이 없으면 빈 문자열.
+    '''
+    if not os.path.exists(path):
+        return ''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    '''
+    렌더링된 음원을 디스크에 저장하는 LRU cache.
+
+    key 는 곡을 결정하는 인자 (genre, mood, tempo, bpm, seed, soundfont hash, 작곡 module 버전) 의 hash.
+    전체 크기가 max_bytes 나 개수가 max_entries 를 넘으면 오래 사용하지 않은 것부터 삭제.
+    설정하지 않은 값은 환경변수에서 읽음.
+        RENDER_CACHE_DIR            저장할 디렉토리 (기본값: ./app/assets/cache/)
+        RENDER_CACHE_MAX_BYTES      최대 전체 크기 (기본값: 1GB)
+        RENDER_CACHE_MAX_ENTRIES    최대 개수 (기본값: 1000)
+    '''
+
+    # put_bytes 는 메모리에 있는 bytes 를 쓰기만 하므로 임시 파일이 이보다 오래 남아있으면 중단된 것 (초).
+    STALE_TMP_AGE = 60
+
+    def __init__(
+        self,
+        cache_dir: Union[str, None] = None,
+        max_bytes: Union[int, None] = None,
+        max_entries: Union[int, None] = None,
+        extension: str = 'mp3',
+    ):
+        self.cache_dir = cache_dir or os.environ.get('RENDER_CACHE_DIR', './app/assets/cache/')
+        self.max_bytes = max_bytes or int(os.environ.get('RENDER_CACHE_MAX_BYTES', 1024 ** 3))
+        self.max_entries = max_entries or int(os.environ.get('RENDER_CACHE_MAX_ENTRIES', 1000))
+        self.extension = extension
+
+        self._entries: OrderedDict[str, int] = OrderedDict()   # key -> 파일 크기, 오래된 순서
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**params) -> str:
+        serialized = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.{self.extension}')
+
+    def load(self):
+        '''
+        재시작 후에도 cache 를 이어서 쓸 수 있도록 디렉토리를 읽어 LRU 순서를 복원.
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        now = time.time()
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith(f'.{self.extension}'):
+                # 쓰다가 중단된 임시 파일. 같은 디렉토리를 쓰는 다른 process 가 쓰고 있는 것은 남겨둠.
+                if name.endswith('.tmp'):
+                    try:
+                        if now - os.path.getmtime(path) > RenderCache.STALE_TMP_AGE:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name[:-len(self.extension) - 1], stat.st_size))
+
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            for (_, key, size) in sorted(files):
+                self._entries[key] = size
+                self._total_bytes += size
+
+            self._evict()
+
+    def get(self, key: str) -> Union[str, None]:
+        '''
+        cache 에 있으면 파일 경로, 없으면 None.
+        '''
+        path = self.path(key)
+        with self._lock:
+            if not os.path.exists(path):
+                if key in self._entries:
+                    self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+
+            if key not in self._entries:
+                # 같은 디렉토리를 쓰는 다른 worker process 가 저장한 파일.
+                self._entries[key] = os.path.getsize(path)
+                self._total_bytes += self._entries[key]
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        # 재시작 후에도 LRU 순서가 유지되도록 mtime 갱신.
+        os.utime(path)
+        return path
+
+    def put_file(self, key: str, src_path: str) -> str:
+        '''
+        src_path 의 파일을 cache 로 옮기고 cache 안의 경로를 반환.
+        다른 filesystem 에 있는 파일은 복사하므로, 다 옮긴 뒤에 보이도록 임시 파일을 거침.
+        '''
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, path)
+        self._add(key, os.path.getsize(path))
+        return path
+
+    def put_bytes(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._add(key, len(data))
+        return path
+
+    def _add(self, key: str, size: int):
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        # 방금 넣은 항목은 바로 응답에 사용되므로 지우지 않음.
+        while len(self._entries) > 1 and (
+            self._total_bytes > self.max_bytes or len(self._entries) > self.max_entries
+        ):
+            (key, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def shrink(self, ratio: float):
+        '''
+        디스크가 부족할 때 전체 크기를 현재의 ratio 배 이하로 줄임.
+        '''
+        with self._lock:
+            target = self._total_bytes * ratio
+            while len(self._entries) > 0 and self._total_bytes > target:
+                (key, size) = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(self.path(key))
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
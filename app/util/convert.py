@@ -1,15 +1,234 @@
 import os
+import time
 import asyncio
 import subprocess
-from pydub import AudioSegment
-
-def midi_to_mp3(midi_file, soundfont, mp3_file):
-    # Convert MIDI to WAV using fluidsynth
-    wav_file = mp3_file.replace('.mp3', '.wav')
-    print(wav_file)
-
-    subprocess.run(
-        f'fluidsynth -ni {soundfont} {midi_file} -F - -r 44100 -o audio.file.type=au -q | ffmpeg -i - -b:a 192K {mp3_file}',
-        shell=True,
-        check=True,
-    )
+import tempfile
+from contextlib import contextmanager
+from typing import Union
+from app.util.formats import DEFAULT_FORMAT, FORMATS, OutputFormat
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def _fluidsynth_args(midi_file, soundfont, output='-', file_type='au', sample_rate=44100):
+    return [
+        'fluidsynth', '-ni', soundfont, midi_file,
+        '-F', output, '-r', str(sample_rate), '-o', f'audio.file.type={file_type}', '-q',
+    ]
+
+def _ffmpeg_args(output, output_format: OutputFormat):
+    return [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-i', '-', *output_format.ffmpeg_args(), output,
+    ]
+
+@contextmanager
+def _midi_source(midi: Union[bytes, str]):
+    '''
+    fluidsynth 에 넘겨줄 midi 경로와 자식 프로세스에 넘겨줄 fd 를 반환.
+
+    fluidsynth 는 midi 를 seek 하면서 읽으므로 stdin pipe 로는 넘길 수 없음.
+    대신 메모리에만 존재하는 memfd 를 /dev/fd/N 경로로 넘겨서 디스크를 거치지 않음.
+    memfd 를 쓸 수 없는 환경에서는 임시 파일을 사용.
+    '''
+    if isinstance(midi, str):
+        yield (midi, ())
+        return
+
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('midi')
+        try:
+            os.write(fd, midi)
+            yield (f'/dev/fd/{fd}', (fd,))
+        finally:
+            os.close(fd)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.mid') as f:
+        f.write(midi)
+        f.flush()
+        yield (f.name, ())
+
+async def _spawn_pipeline(fluidsynth_args, ffmpeg_args, ffmpeg_stdout=None, pass_fds=()):
+    '''
+    fluidsynth 의 출력을 os.pipe 로 ffmpeg 에 바로 연결하므로 shell 을 거치지 않음.
+    '''
+    read_fd, write_fd = os.pipe()
+    processes = []
+    try:
+        processes.append(await asyncio.create_subprocess_exec(
+            *fluidsynth_args,
+            stdout=write_fd,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+        ))
+        processes.append(await asyncio.create_subprocess_exec(
+            *ffmpeg_args,
+            stdin=read_fd,
+            stdout=ffmpeg_stdout,
+            stderr=asyncio.subprocess.PIPE,
+        ))
+    except BaseException:
+        for process in processes:
+            process.kill()
+        raise
+    finally:
+        # 자식 프로세스가 fd 를 물려받았으므로 부모 쪽은 닫아야 EOF 가 전달됨.
+        os.close(read_fd)
+        os.close(write_fd)
+
+    return processes
+
+async def _kill_pipeline(processes):
+    for process in processes:
+        if process.returncode is None:
+            process.kill()
+    # 종료된 프로세스를 회수해야 transport 가 정리됨.
+    await asyncio.gather(*[process.wait() for process in processes], return_exceptions=True)
+
+async def _timed_wait(processes):
+    '''
+    fluidsynth / ffmpeg 가 끝날 때까지 기다리고 [(단계, 초), ...] 를 반환.
+    두 프로세스는 동시에 실행되므로, fluidsynth 가 끝날 때까지를 합성,
+    그 뒤 ffmpeg 가 남은 frame 을 인코딩하는 데 더 걸린 시간을 인코딩으로 봄.
+    '''
+    [fluidsynth, ffmpeg] = processes
+    start = time.perf_counter()
+    await fluidsynth.wait()
+    synthesized = time.perf_counter()
+    await ffmpeg.wait()
+
+    return [('synthesis', synthesized - start), ('encode', time.perf_counter() - synthesized)]
+
+def _check_pipeline(processes, args_list, stderr_list):
+    for (process, args, stderr) in zip(processes, args_list, stderr_list):
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, stderr=stderr)
+
+async def midi_to_audio_async(
+    midi: Union[bytes, str],
+    soundfont,
+    output_file,
+    output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+) -> list[tuple[str, float]]:
+    '''
+    fluidsynth 로 합성하고 ffmpeg 로 output_format 으로 인코딩. 두 프로세스는 asyncio subprocess 로 실행.
+    서버는 section 별로 렌더링하므로, 곡 전체를 한 번에 렌더링하는 비교 기준으로 benchmarks/run.py 에서만 사용.
+    midi 는 파일 경로 또는 midi bytes.
+    합성과 인코딩에 걸린 시간을 [(단계, 초), ...] 로 반환.
+    '''
+    with _midi_source(midi) as (midi_file, pass_fds):
+        fluidsynth_args = _fluidsynth_args(midi_file, soundfont, sample_rate=output_format.sample_rate)
+        ffmpeg_args = _ffmpeg_args(output_file, output_format)
+
+        processes = await _spawn_pipeline(fluidsynth_args, ffmpeg_args, pass_fds=pass_fds)
+        [fluidsynth, ffmpeg] = processes
+        try:
+            (spans, fluidsynth_err, ffmpeg_err) = await asyncio.gather(
+                _timed_wait(processes),
+                fluidsynth.stderr.read(),
+                ffmpeg.stderr.read(),
+            )
+        except BaseException:
+            # timeout 등으로 취소되면 남은 프로세스를 정리.
+            await _kill_pipeline(processes)
+            raise
+
+    _check_pipeline(processes, [fluidsynth_args, ffmpeg_args], [fluidsynth_err, ffmpeg_err])
+    return spans
+
+async def midi_to_pcm_async(
+    midi: Union[bytes, str],
+    soundfont,
+    pcm_file,
+    sample_rate=44100,
+) -> list[tuple[str, float]]:
+    '''
+    midi 를 16bit stereo little endian PCM 파일로 렌더링.
+    합성에 걸린 시간을 [(단계, 초)] 로 반환.
+    '''
+    with _midi_source(midi) as (midi_file, pass_fds):
+        fluidsynth_args = _fluidsynth_args(midi_file, soundfont, pcm_file, 'raw', sample_rate) + [
+            '-o', 'audio.file.format=s16', '-o', 'audio.file.endian=little',
+        ]
+
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *fluidsynth_args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+        try:
+            (_, fluidsynth_err) = await process.communicate()
+        except BaseException:
+            await _kill_pipeline([process])
+            raise
+
+    _check_pipeline([process], [fluidsynth_args], [fluidsynth_err])
+    return [('synthesis', time.perf_counter() - start)]
+
+async def stream_midi_to_audio(
+    midi: Union[bytes, str],
+    soundfont,
+    output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+    chunk_size=STREAM_CHUNK_SIZE,
+    spans: Union[list, None] = None,
+    timeout: Union[float, None] = None,
+):
+    '''
+    ffmpeg 가 output_format 으로 인코딩한 frame 을 만들어지는 대로 yield.
+    인코딩한 파일은 디스크에 쓰지 않음.
+    spans 가 주어지면 끝까지 성공했을 때 합성과 인코딩에 걸린 시간을 (단계, 초) 로 추가함.
+    client 가 천천히 받으면 pipe 가 차서 합성도 그만큼 늦어지므로 그 시간까지 포함됨.
+    timeout 은 ffmpeg 의 출력을 기다린 시간의 합 (초) 의 한도로, yield 한 chunk 를 client 가
+    받아가기를 기다리는 시간은 포함하지 않음. 넘으면 asyncio.TimeoutError.
+    '''
+    with _midi_source(midi) as (midi_file, pass_fds):
+        fluidsynth_args = _fluidsynth_args(midi_file, soundfont, sample_rate=output_format.sample_rate)
+        ffmpeg_args = _ffmpeg_args('pipe:1', output_format)
+
+        processes = await _spawn_pipeline(
+            fluidsynth_args,
+            ffmpeg_args,
+            ffmpeg_stdout=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+        [fluidsynth, ffmpeg] = processes
+        try:
+            # stderr 를 읽지 않으면 pipe buffer 가 차서 멈출 수 있으므로 따로 읽음.
+            stderr_tasks = [
+                asyncio.ensure_future(fluidsynth.stderr.read()),
+                asyncio.ensure_future(ffmpeg.stderr.read()),
+            ]
+            timing_task = asyncio.ensure_future(_timed_wait(processes))
+
+            # 합성 / 인코딩을 기다리는 데 쓸 수 있는 남은 시간.
+            remaining = timeout
+
+            async def wait(awaitable):
+                nonlocal remaining
+                if remaining is None:
+                    return await awaitable
+
+                start = time.perf_counter()
+                try:
+                    return await asyncio.wait_for(awaitable, max(remaining, 0))
+                finally:
+                    remaining -= time.perf_counter() - start
+
+            while True:
+                chunk = await wait(ffmpeg.stdout.read(chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+
+            timing = await wait(timing_task)
+            stderr_list = await wait(asyncio.gather(*stderr_tasks))
+        except BaseException:
+            # client 가 연결을 끊거나 timeout 으로 취소되면 남은 프로세스를 정리.
+            await _kill_pipeline(processes)
+            raise
+
+    _check_pipeline(processes, [fluidsynth_args, ffmpeg_args], stderr_list)
+    if spans is not None:
+        spans.extend(timing)
@@ -0,0 +1,100 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Union
+
+
+def _noop():
+    pass
+
+
+class EngineBusyError(Exception):
+    '''
+    대기열이 가득 차서 작업을 받을 수 없을 때 발생.
+    '''
+
+    def __init__(self, retry_after: int):
+        super().__init__('generation engine is busy')
+        self.retry_after = retry_after
+
+
+class GenerationEngine:
+    '''
+    make_song 처럼 CPU 를 많이 쓰는 작업을 worker process 에서 실행.
+
+    event loop 는 run_in_executor 로 결과를 기다리기만 하므로
+    작곡 중에도 다른 요청을 처리할 수 있음.
+    initializer 는 worker process 가 시작될 때 한 번 실행됨. ex) 작곡 module 을 미리 불러오기
+    설정하지 않은 값은 환경변수에서 읽음.
+        GENERATION_WORKERS      worker process 개수 (기본값: CPU 개수)
+        GENERATION_MAX_QUEUE    worker 가 모두 바쁠 때 대기할 수 있는 작업 수
+        GENERATION_TIMEOUT      작업 하나의 최대 대기 시간 (초)
+        GENERATION_RETRY_AFTER  대기열이 가득 찼을 때 돌려줄 Retry-After (초)
+    '''
+
+    def __init__(
+        self,
+        max_workers: Union[int, None] = None,
+        max_queue: Union[int, None] = None,
+        timeout: Union[float, None] = None,
+        retry_after: Union[int, None] = None,
+        initializer: Union[Callable, None] = None,
+    ):
+        self.initializer = initializer
+        self.max_workers = max_workers or int(os.environ.get('GENERATION_WORKERS', os.cpu_count() or 1))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get('GENERATION_MAX_QUEUE', 32))
+        self.timeout = timeout or float(os.environ.get('GENERATION_TIMEOUT', 60))
+        self.retry_after = retry_after or int(os.environ.get('GENERATION_RETRY_AFTER', 5))
+
+        self._executor: Union[ProcessPoolExecutor, None] = None
+        self._in_flight = 0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+            # worker 는 첫 작업이 들어올 때 만들어지므로, 빈 작업으로 미리 만들어 initializer 를 실행.
+            self._executor.submit(_noop)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        # 실행 중인 작업을 제외하고 대기 중인 작업 수
+        return max(0, self._in_flight - self.max_workers)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        '''
+        fn(*args, **kwargs) 를 worker process 에서 실행하고 결과를 반환.
+        fn 과 인자는 pickle 가능해야 함.
+        '''
+        if self._executor is None:
+            raise Exception('Generation engine is not started.')
+
+        if self._in_flight >= self.max_workers + self.max_queue:
+            raise EngineBusyError(self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        job = self._executor.submit(functools.partial(fn, *args, **kwargs))
+        # timeout 으로 기다리기를 멈춰도 worker 는 작업을 계속하므로, 작업이 실제로 끝날 때 자리를 비움.
+        self._in_flight += 1
+        job.add_done_callback(lambda _: self._release(loop))
+        return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        # executor 의 thread 에서 호출되므로 event loop 에서 값을 바꿈.
+        try:
+            loop.call_soon_threadsafe(self._decrement)
+        except RuntimeError:
+            # event loop 가 이미 닫힘.
+            pass
+
+    def _decrement(self):
+        self._in_flight -= 1
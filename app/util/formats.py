@@ -0,0 +1,117 @@
+from typing import Union
+
+
+class OutputFormat:
+    '''
+    응답으로 보낼 음원 형식과 encoder 설정.
+
+    codec 이 없으면 렌더링하지 않고 midi 를 그대로 보냄.
+    sample_rate 는 subprocess backend 가 합성할 때와 인코딩 결과의 sample rate.
+    quality 는 encoder 의 속도 / 품질 설정으로, 형식마다 의미가 다름.
+        libmp3lame  0 (느림, 고품질) ~ 9 (빠름)
+        libopus     compression level 0 (빠름) ~ 10 (느림, 고품질)
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        media_type: str,
+        extension: str,
+        codec: Union[str, None] = None,
+        container: Union[str, None] = None,
+        bit_rate: Union[int, None] = None,
+        sample_rate: int = 44100,
+        channels: int = 2,
+        quality: Union[int, None] = None,
+        options: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.media_type = media_type
+        self.extension = extension
+        self.codec = codec
+        self.container = container
+        self.bit_rate = bit_rate            # kbps
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.quality = quality
+        self.options = options              # 형식별 ffmpeg 추가 옵션
+
+    @property
+    def rendered(self) -> bool:
+        return self.codec is not None
+
+    @property
+    def is_mp3(self) -> bool:
+        return self.codec == 'libmp3lame'
+
+    def ffmpeg_args(self) -> list[str]:
+        '''
+        ffmpeg 의 출력 옵션. 입력 옵션 뒤, 출력 경로 앞에 둠.
+        '''
+        args = ['-c:a', self.codec, '-b:a', f'{self.bit_rate}K', '-ar', str(self.sample_rate), '-ac', str(self.channels)]
+        if self.quality is not None:
+            args += ['-compression_level', str(self.quality)]
+        return args + list(self.options) + ['-f', self.container]
+
+
+DEFAULT_FORMAT = 'mp3'
+
+FORMATS = {
+    output_format.name: output_format
+    for output_format in [
+        OutputFormat('mp3', 'audio/mpeg', 'mp3', 'libmp3lame', 'mp3', bit_rate=192, quality=2),
+        OutputFormat('mp3-128', 'audio/mpeg', 'mp3', 'libmp3lame', 'mp3', bit_rate=128, quality=5),
+        OutputFormat('mp3-320', 'audio/mpeg', 'mp3', 'libmp3lame', 'mp3', bit_rate=320, quality=2),
+        # opus 는 48kHz 로만 인코딩함.
+        OutputFormat('opus', 'audio/ogg', 'ogg', 'libopus', 'ogg', bit_rate=96, sample_rate=48000, quality=5,
+                     options=('-application', 'audio')),
+        # adts 는 앞에서부터 재생할 수 있으므로 stream 에도 쓸 수 있음.
+        OutputFormat('aac', 'audio/aac', 'aac', 'aac', 'adts', bit_rate=160, options=('-aac_coder', 'fast')),
+        # 미리 듣기용. 합성부터 22.05kHz 로 하고 mono 로 인코딩.
+        OutputFormat('preview', 'audio/mpeg', 'mp3', 'libmp3lame', 'mp3', bit_rate=64, sample_rate=22050,
+                     channels=1, quality=7),
+        OutputFormat('midi', 'audio/midi', 'mid'),
+    ]
+}
+
+# Accept header 의 media type 마다 고를 형식
+ACCEPT_FORMATS = {
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/ogg': 'opus',
+    'audio/opus': 'opus',
+    'audio/aac': 'aac',
+    'audio/mp4': 'aac',
+    'audio/midi': 'midi',
+    'audio/x-midi': 'midi',
+}
+
+
+def negotiate(name: Union[str, None], accept: Union[str, None]) -> OutputFormat:
+    '''
+    요청에서 지정한 형식, 없으면 Accept header 에서 q 값이 가장 큰 형식을 고름.
+    고를 수 있는 형식이 없으면 (ex. */*, application/json) 기본 형식.
+    '''
+    if name is not None:
+        if name not in FORMATS:
+            raise Exception(f'Unsupported format: {name}')
+        return FORMATS[name]
+
+    best = DEFAULT_FORMAT
+    best_q = 0.0
+    for item in (accept or '').split(','):
+        (media_type, *params) = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+
+        # 같은 q 값이면 먼저 나온 형식.
+        if media_type.lower() in ACCEPT_FORMATS and q > best_q:
+            best = ACCEPT_FORMATS[media_type.lower()]
+            best_q = q
+
+    return FORMATS[best]
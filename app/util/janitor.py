@@ -0,0 +1,142 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from typing import Union
+from app.util.cache import RenderCache
+
+logger = logging.getLogger('main')
+
+
+class Janitor:
+    '''
+    임시 음원 디렉토리를 주기적으로 정리하는 단일 background task.
+
+    - 시작할 때 이전 process 가 남긴, startup_age 보다 오래된 파일을 삭제.
+      같은 디렉토리를 쓰는 다른 worker process 가 아직 렌더링 중인 파일은 남겨둠.
+    - max_age 보다 오래된 파일을 삭제.
+    - 디렉토리 크기가 max_bytes 를 넘으면 오래된 파일부터 삭제.
+    - 디스크 사용률이 high_water 를 넘으면 임시 파일과 render cache 를 즉시 줄임.
+    min_age 안에 수정된 파일은 아직 렌더링 중일 수 있으므로 크기 / 디스크 때문에 삭제하지 않음.
+    설정하지 않은 값은 환경변수에서 읽음.
+        JANITOR_INTERVAL        정리 주기 (초, 기본값: 60)
+        MUSIC_FILE_MAX_AGE      임시 파일을 보관하는 최대 시간 (초, 기본값: 600)
+        MUSIC_FILE_STARTUP_AGE  시작할 때 삭제할 파일의 최소 나이 (초, 기본값: 120)
+        MUSIC_DIR_MAX_BYTES     임시 디렉토리의 최대 크기 (기본값: 512MB)
+        DISK_HIGH_WATER         즉시 정리를 시작하는 디스크 사용률 (기본값: 0.9)
+    '''
+
+    MIN_AGE = 10                # 크기 / 디스크 때문에 삭제하지 않는, 최근에 수정된 파일의 기준 (초)
+    CACHE_SHRINK_RATIO = 0.5    # 디스크가 부족할 때 render cache 를 줄이는 비율
+
+    def __init__(
+        self,
+        music_dir: str,
+        render_caches: Union[list[RenderCache], None] = None,
+        interval: Union[float, None] = None,
+        max_age: Union[float, None] = None,
+        startup_age: Union[float, None] = None,
+        max_bytes: Union[int, None] = None,
+        high_water: Union[float, None] = None,
+    ):
+        self.music_dir = music_dir
+        self.render_caches = render_caches or []
+        self.interval = interval or float(os.environ.get('JANITOR_INTERVAL', 60))
+        self.max_age = max_age or float(os.environ.get('MUSIC_FILE_MAX_AGE', 600))
+        self.startup_age = startup_age or float(os.environ.get('MUSIC_FILE_STARTUP_AGE', 120))
+        self.max_bytes = max_bytes or int(os.environ.get('MUSIC_DIR_MAX_BYTES', 512 * 1024 ** 2))
+        self.high_water = high_water or float(os.environ.get('DISK_HIGH_WATER', 0.9))
+
+        self._task: Union[asyncio.Task, None] = None
+        self.removed_files = 0
+        self.removed_bytes = 0
+
+    def start(self):
+        # 이전 process 가 남긴 파일은 더 이상 쓰이지 않음.
+        # 다른 worker process 가 렌더링 중인 파일은 startup_age 보다 새로우므로 남음.
+        self._sweep(self.startup_age)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f'janitor sweep failed: {e}')
+
+    def _files(self) -> list[tuple[float, int, str]]:
+        '''
+        (mtime, size, path) 를 오래된 순서로 반환.
+        '''
+        files = []
+        for entry in os.scandir(self.music_dir):
+            if not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(files)
+
+    def _remove(self, path: str, size: int):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self.removed_files += 1
+        self.removed_bytes += size
+
+    def disk_usage(self) -> float:
+        usage = shutil.disk_usage(self.music_dir)
+        return usage.used / usage.total
+
+    def sweep(self):
+        self._sweep(self.max_age)
+
+    def _sweep(self, max_age: float):
+        if not os.path.isdir(self.music_dir):
+            return
+
+        now = time.time()
+        files = self._files()
+        total_bytes = sum(size for (_, size, _) in files)
+        high_water = self.disk_usage() > self.high_water
+
+        remaining = []
+        for (mtime, size, path) in files:
+            age = now - mtime
+            if age > max_age or (high_water and age > Janitor.MIN_AGE):
+                self._remove(path, size)
+                total_bytes -= size
+            else:
+                remaining.append((mtime, size, path))
+
+        for (mtime, size, path) in remaining:
+            if total_bytes <= self.max_bytes:
+                break
+            if now - mtime <= Janitor.MIN_AGE:
+                continue
+            self._remove(path, size)
+            total_bytes -= size
+
+        if high_water and len(self.render_caches) > 0:
+            logger.warning('disk usage is over the high-water mark, shrinking render cache')
+            for render_cache in self.render_caches:
+                render_cache.shrink(Janitor.CACHE_SHRINK_RATIO)
+
+    def stats(self) -> dict:
+        return {
+            'removed_files': self.removed_files,
+            'removed_bytes': self.removed_bytes,
+        }
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Union
+
+logger = logging.getLogger('main')
+
+QUEUED = 'queued'
+COMPOSING = 'composing'
+RENDERING = 'rendering'
+DONE = 'done'
+FAILED = 'failed'
+
+FINISHED_STATES = [DONE, FAILED]
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Job:
+    def __init__(
+        self,
+        id: str,
+        params: dict,
+        state: str = QUEUED,
+        result: Union[str, None] = None,
+        error: Union[str, None] = None,
+        created_at: Union[float, None] = None,
+        updated_at: Union[float, None] = None,
+    ):
+        self.id = id
+        self.params = params                # 곡을 만드는 인자. ex) {'genre': 'retro', 'seed': 3, ...}
+        self.state = state
+        self.result = result                # 완료된 곡의 cache key
+        self.error = error
+        self.created_at = created_at if created_at is not None else time.time()
+        self.updated_at = updated_at if updated_at is not None else self.created_at
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'params': self.params,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class MemoryJobStore:
+    '''
+    process 안에서만 유지되는 job 저장소.
+    완료된 job 은 ttl 이 지나면 삭제.
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._jobs: OrderedDict[str, Job] = OrderedDict()    # 생성 순서
+
+    def add(self, job: Job):
+        self._purge()
+        self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        return self._jobs.get(job_id)
+
+    def update(self, job_id: str, **fields):
+        job = self._jobs[job_id]
+        for (key, value) in fields.items():
+            setattr(job, key, value)
+        job.updated_at = time.time()
+
+    def position(self, job_id: str) -> int:
+        '''
+        자신보다 먼저 들어와 아직 대기 중인 job 수.
+        '''
+        count = 0
+        for (other_id, other) in self._jobs.items():
+            if other_id == job_id:
+                return count
+            if other.state == QUEUED:
+                count += 1
+        return count
+
+    def fail_abandoned(self) -> int:
+        # process 가 끝나면 job 도 함께 사라짐.
+        return 0
+
+    def _purge(self):
+        expire = time.time() - self.ttl
+        for job in list(self._jobs.values()):
+            if job.state in FINISHED_STATES and job.updated_at < expire:
+                del self._jobs[job.id]
+
+
+class SQLiteJobStore:
+    '''
+    여러 uvicorn worker 가 job 상태를 공유하기 위한 SQLite 저장소.
+    job 은 제출받은 worker 의 queue 에서 처리되지만, 조회는 어느 worker 에서든 가능.
+    job 마다 제출받은 worker 의 pid 를 기록하여, 그 worker 가 끝나 처리되지 못할 job 을 찾음.
+    '''
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                params TEXT NOT NULL,
+                state TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)')
+        # pid column 이 없던 이전 버전의 파일
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if 'pid' not in columns:
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+
+    def add(self, job: Job):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?',
+                (*FINISHED_STATES, time.time() - self.ttl),
+            )
+            self._conn.execute(
+                'INSERT INTO jobs (id, params, state, result, error, created_at, updated_at, pid) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    job.id, json.dumps(job.params), job.state, job.result, job.error,
+                    job.created_at, job.updated_at, os.getpid(),
+                ),
+            )
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, params, state, result, error, created_at, updated_at FROM jobs WHERE id = ?',
+                (job_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        (id, params, state, result, error, created_at, updated_at) = row
+        return Job(id, json.loads(params), state, result, error, created_at, updated_at)
+
+    def update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{key} = ?' for key in fields.keys())
+        with self._lock:
+            self._conn.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def fail_abandoned(self) -> int:
+        '''
+        끝난 worker 가 남긴, 완료되지 않은 job 을 실패로 바꾸고 그 수를 반환.
+        queue 는 process 안에만 있으므로 이런 job 은 더 이상 처리되지 않음.
+        아직 job 을 받지 않은 지금 process 와 같은 pid 로 남은 job 도 이전 process 의 것.
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT DISTINCT pid FROM jobs WHERE state NOT IN (?, ?)',
+                FINISHED_STATES,
+            ).fetchall()
+
+            failed = 0
+            for (pid,) in rows:
+                if pid is not None and pid != os.getpid() and _process_alive(pid):
+                    continue
+                failed += self._conn.execute(
+                    'UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE pid IS ? AND state NOT IN (?, ?)',
+                    (FAILED, 'worker stopped', time.time(), pid, *FINISHED_STATES),
+                ).rowcount
+        return failed
+
+    def position(self, job_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state = ? AND seq < (SELECT seq FROM jobs WHERE id = ?)',
+                (QUEUED, job_id),
+            ).fetchone()
+        return row[0]
+
+
+class JobQueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__('job queue is full')
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    '''
+    곡 생성 job 을 받아 background worker 가 순서대로 처리.
+
+    runner 는 (job, set_state) 를 받아 완료된 곡의 cache key 를 반환하는 coroutine.
+    대기열은 process 안에만 있으므로, 시작할 때 끝난 worker 가 남긴 완료되지 않은 job 은 실패로 표시.
+    설정하지 않은 값은 환경변수에서 읽음.
+        JOB_STORE       memory 또는 sqlite (기본값: memory)
+        JOB_DB_PATH     sqlite 파일 경로 (기본값: ./app/assets/jobs.db)
+        JOB_WORKERS     동시에 처리할 job 수 (기본값: 2)
+        JOB_MAX_QUEUE   대기할 수 있는 job 수 (기본값: 1000)
+        JOB_TTL         완료된 job 을 보관하는 시간 (초, 기본값: 3600)
+    '''
+
+    RETRY_AFTER = 5
+
+    def __init__(
+        self,
+        runner: Callable[[Job, Callable[[str], None]], Awaitable[str]],
+        store: Union[MemoryJobStore, SQLiteJobStore, None] = None,
+        workers: Union[int, None] = None,
+        max_queue: Union[int, None] = None,
+    ):
+        self.runner = runner
+        self.workers = workers or int(os.environ.get('JOB_WORKERS', 2))
+        self.max_queue = max_queue or int(os.environ.get('JOB_MAX_QUEUE', 1000))
+
+        if store is None:
+            ttl = float(os.environ.get('JOB_TTL', 3600))
+            if os.environ.get('JOB_STORE', 'memory') == 'sqlite':
+                store = SQLiteJobStore(os.environ.get('JOB_DB_PATH', './app/assets/jobs.db'), ttl)
+            else:
+                store = MemoryJobStore(ttl)
+        self.store = store
+
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if len(self._tasks) == 0:
+            failed = self.store.fail_abandoned()
+            if failed > 0:
+                logger.warning(f'{failed} jobs left by stopped workers are marked as failed')
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, params: dict) -> Job:
+        if self._queue.qsize() >= self.max_queue:
+            raise JobQueueFullError(JobQueue.RETRY_AFTER)
+
+        job = Job(str(uuid.uuid4()), params)
+        self.store.add(job)
+        self._queue.put_nowait(job.id)
+        return job
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        return self.store.get(job_id)
+
+    def position(self, job_id: str) -> int:
+        return self.store.position(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = self.store.get(job_id)
+        if job is None:
+            return
+
+        def set_state(state: str):
+            self.store.update(job_id, state=state)
+
+        try:
+            result = await self.runner(job, set_state)
+        except asyncio.CancelledError:
+            self.store.update(job_id, state=FAILED, error='cancelled')
+            raise
+        except Exception as e:
+            logger.error(f'job {job_id} failed: {e}')
+            self.store.update(job_id, state=FAILED, error=str(e))
+            return
+
+        self.store.update(job_id, state=DONE, result=result)
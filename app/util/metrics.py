@@ -0,0 +1,100 @@
+import time
+from typing import Callable, Iterable
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# 단계별 소요 시간 (초).
+#   validation      요청 수신부터 body 검증이 끝나고 endpoint 가 시작될 때까지
+#   plan_song       곡의 bpm, section 구성 결정
+#   create_part     section 하나의 작곡 (곡마다 section 수만큼 기록)
+#   merge_part      section 들을 곡 순서대로 이어 붙임. section 별 midi 를 만들 때는 section 마다 기록
+#   midi_write      midi bytes 직렬화. section 별 midi 를 만들 때는 section 마다 기록
+#   synthesis       fluidsynth 합성. section 별로 렌더링할 때는 section 마다 기록
+#   splice          section 별로 렌더링한 PCM 을 하나로 합침
+#   encode          mp3 인코딩. subprocess backend 는 합성이 끝난 뒤 ffmpeg 가 더 걸린 시간
+#   response_send   응답 header 를 보낸 뒤 body 를 모두 보낼 때까지
+STAGE_SECONDS = Histogram(
+    'gene_stage_seconds',
+    'Time spent in each stage of music generation.',
+    ['stage'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+
+GENERATION_IN_FLIGHT = Gauge('gene_generation_in_flight', 'Songs being composed or waiting for a worker.')
+GENERATION_QUEUE_DEPTH = Gauge('gene_generation_queue_depth', 'Songs waiting for a generation worker.')
+RENDER_IN_FLIGHT = Gauge('gene_render_in_flight', 'Songs being rendered.')
+RENDER_QUEUE_DEPTH = Gauge('gene_render_queue_depth', 'Songs waiting for a render slot.')
+JOB_QUEUE_DEPTH = Gauge('gene_job_queue_depth', 'Jobs waiting to be run.')
+
+# 미리 만들어 둔 곡. bucket 은 {genre}_{mood}_{tempo}.
+POOL_DEPTH = Gauge('gene_pool_depth', 'Pre-rendered songs waiting in each pool bucket.', ['bucket'])
+POOL_REFILL_LAG = Gauge(
+    'gene_pool_refill_lag_seconds',
+    'Seconds since each pool bucket fell below its target depth.',
+    ['bucket'],
+)
+POOL_HITS = Counter('gene_pool_hits', 'Requests served from the song pool.', ['bucket'])
+POOL_MISSES = Counter('gene_pool_misses', 'Requests that found their pool bucket empty.', ['bucket'])
+
+
+def observe(spans: Iterable[tuple[str, float]]):
+    '''
+    worker process 에서 잰 [(단계, 초), ...] 를 기록.
+    '''
+    for (stage, seconds) in spans:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_since(stage: str, start: float):
+    '''
+    time.perf_counter() 로 잰 start 부터 지금까지를 기록.
+    '''
+    STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def track(gauge: Gauge, fn: Callable[[], float], **labels: str):
+    '''
+    scrape 할 때마다 fn() 의 값을 gauge 로 보고. gauge 에 label 이 있으면 labels 로 지정.
+    '''
+    if len(labels) > 0:
+        gauge = gauge.labels(**labels)
+    gauge.set_function(fn)
+
+
+def latest() -> tuple[bytes, str]:
+    return (generate_latest(), CONTENT_TYPE_LATEST)
+
+
+class TimingMiddleware:
+    '''
+    요청을 받은 시각을 request.state.received_at 에 기록하고,
+    paths 로 시작하는 요청은 응답 body 를 보내는 데 걸린 시간을 response_send 로 기록.
+    '''
+
+    def __init__(self, app: ASGIApp, paths: tuple[str, ...] = ('/',)):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault('state', {})['received_at'] = time.perf_counter()
+        if not scope['path'].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        started_at = None
+
+        async def timed_send(message: Message):
+            nonlocal started_at
+            if message['type'] == 'http.response.start':
+                started_at = time.perf_counter()
+
+            await send(message)
+
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                observe_since('response_send', started_at)
+
+        await self.app(scope, receive, timed_send)
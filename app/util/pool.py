@@ -0,0 +1,248 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import secrets
+from typing import Union
+from app import generator
+from app.util import metrics
+from app.util.engine import GenerationEngine
+from app.util.render import RenderFarm
+
+logger = logging.getLogger('main')
+
+
+class PooledSong:
+    def __init__(self, path: str, seed: int):
+        self.path = path
+        self.seed = seed
+
+
+class SongPool:
+    '''
+    (genre, mood, tempo) bucket 마다 미리 렌더링해 둔, 아직 제공하지 않은 곡을 보관.
+
+    요청이 오면 bucket 에서 곡을 하나 꺼내 바로 응답하고,
+    background worker 가 engine / render farm 이 한가할 때 bucket 을 target_depth 까지 다시 채움.
+    곡은 작곡 module 버전과 soundfont hash 별 디렉토리에 {genre}_{mood}_{tempo}/{seed}.mp3 로 저장되므로
+    재시작 후에도 그대로 사용할 수 있음.
+    설정하지 않은 값은 환경변수에서 읽음.
+        SONG_POOL_DIR       저장할 디렉토리 (기본값: ./app/assets/pool/)
+        SONG_POOL_DEPTH     bucket 마다 유지할 곡 수 (기본값: 2, 0 이면 사용하지 않음)
+        SONG_POOL_WORKERS   동시에 채우는 worker 수 (기본값: 1)
+    '''
+
+    IDLE_INTERVAL = 1.0     # engine / render farm 이 바쁠 때 다시 확인하기까지 기다리는 시간 (초)
+
+    def __init__(
+        self,
+        engine: GenerationEngine,
+        render_farm: RenderFarm,
+        buckets: list[tuple[str, str, str]],
+        pool_dir: Union[str, None] = None,
+        target_depth: Union[int, None] = None,
+        workers: Union[int, None] = None,
+    ):
+        self.engine = engine
+        self.render_farm = render_farm
+        self.buckets = list(buckets)
+        self.pool_dir = pool_dir or os.environ.get('SONG_POOL_DIR', './app/assets/pool/')
+        self.target_depth = target_depth if target_depth is not None else int(os.environ.get('SONG_POOL_DEPTH', 2))
+        self.workers = workers or int(os.environ.get('SONG_POOL_WORKERS', 1))
+
+        self._songs: dict[tuple[str, str, str], list[PooledSong]] = {bucket: [] for bucket in self.buckets}
+        self._filling: dict[tuple[str, str, str], int] = {bucket: 0 for bucket in self.buckets}
+        self._deficit_since: dict[tuple[str, str, str], Union[float, None]] = {bucket: None for bucket in self.buckets}
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.refilled = 0
+
+    @staticmethod
+    def bucket_name(bucket: tuple[str, str, str]) -> str:
+        return '_'.join(bucket)
+
+    @property
+    def enabled(self) -> bool:
+        return self.target_depth > 0
+
+    def _root(self) -> str:
+        soundfont = self.render_farm.soundfont_hash[:16] or 'default'
+        return os.path.join(self.pool_dir, f'v{generator.COMPOSER_VERSION}_{soundfont}')
+
+    def _bucket_dir(self, bucket: tuple[str, str, str]) -> str:
+        return os.path.join(self._root(), SongPool.bucket_name(bucket))
+
+    def load(self):
+        '''
+        디스크에 남아있는 곡을 bucket 에 복원.
+        다른 버전의 작곡 module 이나 다른 soundfont 로 만든 곡과 쓰다가 중단된 임시 파일은 삭제.
+        '''
+        if not self.enabled:
+            return
+
+        os.makedirs(self.pool_dir, exist_ok=True)
+        root = self._root()
+        for name in os.listdir(self.pool_dir):
+            path = os.path.join(self.pool_dir, name)
+            if path != root and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+        for bucket in self.buckets:
+            bucket_dir = self._bucket_dir(bucket)
+            os.makedirs(bucket_dir, exist_ok=True)
+
+            songs = []
+            for name in os.listdir(bucket_dir):
+                path = os.path.join(bucket_dir, name)
+                (seed, ext) = os.path.splitext(name)
+                if ext != '.mp3' or not seed.isdigit():
+                    os.remove(path)
+                    continue
+                songs.append(PooledSong(path, int(seed)))
+
+            self._songs[bucket] = songs
+            self._update_deficit(bucket)
+
+    def start(self):
+        if not self.enabled or len(self._tasks) > 0:
+            return
+
+        self._wake.set()
+        self._tasks = [asyncio.create_task(self._refill_loop()) for _ in range(self.workers)]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def pop(self, genre: str, mood: str, tempo: str) -> Union[PooledSong, None]:
+        '''
+        bucket 에서 곡을 하나 꺼냄. 꺼낸 파일은 호출한 쪽이 옮기거나 삭제해야 함.
+        '''
+        bucket = (genre, mood, tempo)
+        if not self.enabled or bucket not in self._songs:
+            return None
+
+        songs = self._songs[bucket]
+        if len(songs) == 0:
+            self.misses += 1
+            metrics.POOL_MISSES.labels(SongPool.bucket_name(bucket)).inc()
+            return None
+
+        self.hits += 1
+        metrics.POOL_HITS.labels(SongPool.bucket_name(bucket)).inc()
+        song = songs.pop(0)
+        self._update_deficit(bucket)
+        self._wake.set()
+        return song
+
+    def _update_deficit(self, bucket: tuple[str, str, str]):
+        # bucket 이 target_depth 보다 적어진 시점을 기록하여 refill lag 을 계산.
+        if len(self._songs[bucket]) >= self.target_depth:
+            self._deficit_since[bucket] = None
+        elif self._deficit_since[bucket] is None:
+            self._deficit_since[bucket] = time.monotonic()
+
+    def _next_bucket(self) -> Union[tuple[str, str, str], None]:
+        '''
+        채워야 할 곡이 가장 많이 남은 bucket.
+        '''
+        best = None
+        best_deficit = 0
+        for bucket in self.buckets:
+            deficit = self.target_depth - len(self._songs[bucket]) - self._filling[bucket]
+            if deficit > best_deficit:
+                best = bucket
+                best_deficit = deficit
+        return best
+
+    def _is_idle(self) -> bool:
+        # 사용자 요청이 기다리고 있으면 채우지 않음.
+        return (
+            self.engine.queue_depth == 0
+            and self.render_farm.queue_depth == 0
+            and self.render_farm.in_flight < self.render_farm.slots
+        )
+
+    async def _refill_loop(self):
+        while True:
+            bucket = self._next_bucket()
+            if bucket is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            if not self._is_idle():
+                await asyncio.sleep(SongPool.IDLE_INTERVAL)
+                continue
+
+            self._filling[bucket] += 1
+            try:
+                await self._fill(bucket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'song pool refill failed: {e}')
+                await asyncio.sleep(SongPool.IDLE_INTERVAL)
+            finally:
+                self._filling[bucket] -= 1
+
+    async def _fill(self, bucket: tuple[str, str, str]):
+        (genre, mood, tempo) = bucket
+        seed = secrets.randbits(63)
+
+        (composition, spans) = await self.engine.run(
+            generator.compose_parts_timed,
+            genre=genre,
+            mood=mood,
+            tempo=tempo,
+            seed=seed,
+        )
+        metrics.observe(spans)
+
+        path = os.path.join(self._bucket_dir(bucket), f'{seed}.mp3')
+        tmp_path = path + '.tmp'
+        try:
+            await self.render_farm.render_parts(composition, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._songs[bucket].append(PooledSong(path, seed))
+        self._update_deficit(bucket)
+        self.refilled += 1
+
+    def depth(self, bucket: tuple[str, str, str]) -> int:
+        return len(self._songs[bucket])
+
+    def refill_lag(self, bucket: tuple[str, str, str]) -> float:
+        '''
+        bucket 이 target_depth 보다 적어진 뒤 지난 시간 (초). 가득 차 있으면 0.
+        '''
+        since = self._deficit_since[bucket]
+        if since is None:
+            return 0.0
+        return time.monotonic() - since
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'target_depth': self.target_depth,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refilled': self.refilled,
+            'buckets': {
+                SongPool.bucket_name(bucket): {
+                    'depth': self.depth(bucket),
+                    'filling': self._filling[bucket],
+                    'refill_lag': round(self.refill_lag(bucket), 3),
+                }
+                for bucket in self.buckets
+            },
+        }
@@ -0,0 +1,136 @@
+import os
+import re
+import time
+import random
+import cProfile
+import secrets
+from typing import Callable, Union
+
+PROFILE_NAME_PATTERN = '^[0-9]+-[0-9a-f]+_[a-z]+\\.pstats$'
+
+
+def run_profiled(path: str, fn: Callable, *args, **kwargs):
+    '''
+    fn(*args, **kwargs) 를 cProfile 로 실행하고 결과를 pstats 파일로 저장.
+    worker process 에서 실행되므로 module 의 최상위 함수여야 함.
+    '''
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn, *args, **kwargs)
+    finally:
+        profile.dump_stats(path)
+
+
+class Profiler:
+    '''
+    요청 중 일부를 골라 작곡 / 렌더링을 cProfile 로 실행하고 pstats 파일로 보관.
+
+    X-Profile header 가 token 과 같거나, sample_rate 의 확률로 뽑힌 요청을 profile 함.
+    token 을 설정하지 않으면 header 로 profile 하거나 profile 을 조회할 수 없고 sampling 만 동작함.
+    profile 은 {id}_{단계}.pstats 로 저장되고, 새 요청을 profile 하거나 목록을 볼 때
+    max_files 개를 넘는 오래된 것부터 삭제.
+    subprocess 렌더링은 fluidsynth / ffmpeg 프로세스가 일을 하므로 profile 하지 않음.
+    설정하지 않은 값은 환경변수에서 읽음.
+        PROFILE_DIR             저장할 디렉토리 (기본값: ./app/assets/profiles/)
+        PROFILE_SAMPLE_RATE     header 없이 profile 할 요청의 비율 (0 ~ 1, 기본값: 0)
+        PROFILE_MAX_FILES       보관할 profile 파일 수 (기본값: 50)
+        PROFILE_TOKEN           X-Profile header 와 profile 조회에 필요한 값 (기본값: 없음, 사용하지 않음)
+    '''
+
+    def __init__(
+        self,
+        profile_dir: Union[str, None] = None,
+        sample_rate: Union[float, None] = None,
+        max_files: Union[int, None] = None,
+        token: Union[str, None] = None,
+    ):
+        self.profile_dir = profile_dir or os.environ.get('PROFILE_DIR', './app/assets/profiles/')
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+        self.max_files = max_files or int(os.environ.get('PROFILE_MAX_FILES', 50))
+        self.token = token if token is not None else os.environ.get('PROFILE_TOKEN', '')
+
+        self.sampled = 0
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+    def authorized(self, token: Union[str, None]) -> bool:
+        # token 을 설정하지 않으면 아무도 사용할 수 없음.
+        if self.token == '':
+            return False
+        return token is not None and secrets.compare_digest(token, self.token)
+
+    def sample(self, header: Union[str, None] = None) -> Union[str, None]:
+        '''
+        이번 요청을 profile 하면 profile id, 아니면 None.
+        id 는 만든 시각 (ms) 으로 시작하므로 이름 순서가 시간 순서와 같음.
+        '''
+        if header is not None and self.authorized(header):
+            pass
+        elif self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        self._prune()
+        self.sampled += 1
+        return f'{time.time_ns() // 1_000_000}-{secrets.token_hex(4)}'
+
+    def path(self, profile_id: Union[str, None], stage: str) -> Union[str, None]:
+        '''
+        profile 을 저장할 경로. profile_id 가 None 이면 None.
+        '''
+        if profile_id is None:
+            return None
+
+        return os.path.join(self.profile_dir, f'{profile_id}_{stage}.pstats')
+
+    def _prune(self):
+        '''
+        max_files 개만 남기고 오래된 profile 부터 삭제.
+        '''
+        names = sorted(self._names())
+        for name in names[:max(0, len(names) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.profile_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _names(self) -> list[str]:
+        try:
+            return [name for name in os.listdir(self.profile_dir) if re.match(PROFILE_NAME_PATTERN, name)]
+        except FileNotFoundError:
+            return []
+
+    def list(self) -> list[dict]:
+        '''
+        보관 중인 profile 을 최신 순으로.
+        '''
+        self._prune()
+
+        profiles = []
+        for name in sorted(self._names(), reverse=True):
+            try:
+                stat = os.stat(os.path.join(self.profile_dir, name))
+            except FileNotFoundError:
+                continue
+            profiles.append({'name': name, 'size': stat.st_size, 'created_at': stat.st_mtime})
+        return profiles
+
+    def get(self, name: str) -> Union[str, None]:
+        '''
+        profile 이 있으면 파일 경로, 없으면 None.
+        '''
+        if not re.match(PROFILE_NAME_PATTERN, name):
+            return None
+
+        path = os.path.join(self.profile_dir, name)
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def stats(self) -> dict:
+        return {
+            'sample_rate': self.sample_rate,
+            'max_files': self.max_files,
+            'sampled': self.sampled,
+            'files': len(self._names()),
+        }
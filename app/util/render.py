@@ -0,0 +1,314 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Union
+from app.util import convert, metrics, synth
+from app.util.cache import file_hash
+from app.util.formats import DEFAULT_FORMAT, FORMATS, OutputFormat
+from app.util.profiler import run_profiled
+
+
+def section_offsets(form: list[str], beats: dict[str, float], bpm: int) -> list[float]:
+    '''
+    곡 순서대로 나오는 section 들의 시작 시각 (초).
+    '''
+    offsets = []
+    elapsed = 0.0
+    for name in form:
+        offsets.append(elapsed * 60 / bpm)
+        elapsed += beats[name]
+    return offsets
+
+
+class RenderBusyError(Exception):
+    '''
+    모든 render slot 과 대기열이 가득 찼을 때 발생.
+    '''
+
+    def __init__(self, retry_after: int):
+        super().__init__('render farm is busy')
+        self.retry_after = retry_after
+
+
+class RenderStream:
+    '''
+    RenderFarm.stream 이 돌려주는 async iterator.
+    만들어질 때 이미 render slot 을 차지하고 있으므로, 끝까지 읽거나 오류가 나거나 닫히거나
+    한 번도 읽지 않고 버려질 때 release 를 한 번만 호출하여 slot 을 돌려줌.
+    '''
+
+    def __init__(self, chunks, release: Callable[[], None]):
+        self._chunks = chunks
+        self._release: Union[Callable[[], None], None] = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            # fluidsynth / ffmpeg 는 chunks 가 오류를 내기 전에 정리됨.
+            self._finish()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._chunks.aclose()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if self._release is not None:
+            (release, self._release) = (self._release, None)
+            release()
+
+    def __del__(self):
+        self._finish()
+
+
+class RenderFarm:
+    '''
+    fluidsynth / ffmpeg 렌더링을 동시에 slots 개까지 실행.
+
+    slot 이 모두 차면 max_queue 개까지 기다리고, 그 이상은 RenderBusyError 로 거절.
+    backend 는 두 가지.
+        synth       soundfont 를 한 번 읽어둔 worker process 가 직접 합성 (pyfluidsynth 필요)
+        subprocess  요청마다 fluidsynth / ffmpeg 프로세스를 실행
+    section 별로 렌더링한 PCM 을 합치는 작업은 backend 와 관계없이 worker process 에서 실행.
+    인코딩 형식은 요청마다 OutputFormat 으로 정함. subprocess backend 는 형식의 sample rate 로 합성하고,
+    synth backend 는 worker 의 synthesizer 가 고정된 sample rate 로 합성한 뒤 인코딩하면서 바꿈.
+    설정하지 않은 값은 환경변수에서 읽음.
+        RENDER_BACKEND      synth, subprocess, auto (기본값: auto, synth 가 가능하면 synth)
+        RENDER_SLOTS        동시에 실행할 렌더링 수 (기본값: CPU 개수)
+        RENDER_MAX_QUEUE    slot 을 기다릴 수 있는 렌더링 수
+        RENDER_TIMEOUT      렌더링 하나의 최대 시간 (초)
+        RENDER_RETRY_AFTER  대기열이 가득 찼을 때 돌려줄 Retry-After (초)
+    '''
+
+    def __init__(
+        self,
+        soundfont: str,
+        backend: Union[str, None] = None,
+        slots: Union[int, None] = None,
+        max_queue: Union[int, None] = None,
+        timeout: Union[float, None] = None,
+        retry_after: Union[int, None] = None,
+    ):
+        self.soundfont = soundfont
+        self.soundfont_hash = ''
+        self.backend = backend or os.environ.get('RENDER_BACKEND', 'auto')
+        if self.backend == 'auto':
+            self.backend = 'synth' if synth.available() else 'subprocess'
+        if self.backend not in ['synth', 'subprocess']:
+            raise Exception(f'Unsupported render backend: {self.backend}')
+
+        self.slots = slots or int(os.environ.get('RENDER_SLOTS', os.cpu_count() or 1))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get('RENDER_MAX_QUEUE', 16))
+        self.timeout = timeout or float(os.environ.get('RENDER_TIMEOUT', 120))
+        self.retry_after = retry_after or int(os.environ.get('RENDER_RETRY_AFTER', 5))
+
+        self._semaphore = asyncio.Semaphore(self.slots)
+        self._executor: Union[ProcessPoolExecutor, None] = None
+        self._in_flight = 0
+        self._rendering = 0
+
+    def start(self):
+        # 같은 곡이라도 soundfont 가 바뀌면 다른 음원이 되므로 cache key 에 포함됨.
+        self.soundfont_hash = file_hash(self.soundfont)
+
+        if self._executor is not None:
+            return
+
+        if self.backend == 'synth':
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.slots,
+                initializer=synth.init_worker,
+                initargs=(self.soundfont,),
+            )
+        else:
+            # subprocess backend 는 section 별 PCM 을 합칠 때만 사용.
+            self._executor = ProcessPoolExecutor(max_workers=self.slots)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._rendering
+
+    @property
+    def queue_depth(self) -> int:
+        return self._in_flight - self._rendering
+
+    async def _execute(self, fn: Callable, *args):
+        '''
+        worker process 에서 fn(*args) 를 실행.
+        취소되어도 이미 시작한 작업은 worker 에서 계속 실행되므로, 끝날 때까지 기다린 뒤 취소를 전달함.
+        그래야 _run 이 작업이 실제로 끝난 뒤에 slot 을 돌려줌.
+        '''
+        job = self._executor.submit(fn, *args)
+        future = asyncio.wrap_future(job)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not job.cancel():
+                await asyncio.wait([future])
+            raise
+
+    async def _render_segment(self, midi, pcm_file) -> list[tuple[str, float]]:
+        if self.backend == 'subprocess':
+            return await convert.midi_to_pcm_async(midi, self.soundfont, pcm_file)
+
+        return await self._execute(synth.midi_to_pcm, midi, pcm_file)
+
+    async def _splice(
+        self, segment_files, offsets, output_file, output_format, sample_rate=synth.SAMPLE_RATE,
+    ) -> list[tuple[str, float]]:
+        return await self._execute(
+            synth.splice_to_audio, segment_files, offsets, output_file, output_format, sample_rate,
+        )
+
+    async def _render_parts(
+        self, composition: dict, output_file, output_format, profile_path=None,
+    ) -> list[tuple[str, float]]:
+        parts = composition['parts']
+        form = composition['form']
+        offsets = section_offsets(form, {name: part['beats'] for (name, part) in parts.items()}, composition['bpm'])
+
+        if self.backend == 'synth':
+            midis = {name: part['midi'] for (name, part) in parts.items()}
+            if profile_path is not None:
+                return await self._execute(
+                    run_profiled, profile_path, synth.parts_to_audio, midis, form, offsets, output_file, output_format,
+                )
+            return await self._execute(synth.parts_to_audio, midis, form, offsets, output_file, output_format)
+
+        # slot 하나에서 section 을 차례대로 합성하므로 동시에 실행되는 fluidsynth 수는 그대로임.
+        # 미리 듣기처럼 sample rate 가 낮은 형식은 합성부터 그 sample rate 로 함.
+        sample_rate = output_format.sample_rate
+        names = list(dict.fromkeys(form))
+        pcm_files = {name: f'{output_file}.{index}.pcm' for (index, name) in enumerate(names)}
+        spans = []
+        try:
+            for name in names:
+                spans += await convert.midi_to_pcm_async(
+                    parts[name]['midi'], self.soundfont, pcm_files[name], sample_rate,
+                )
+            spans += await self._splice(
+                [pcm_files[name] for name in form], offsets, output_file, output_format, sample_rate,
+            )
+        finally:
+            for pcm_file in pcm_files.values():
+                if os.path.exists(pcm_file):
+                    os.remove(pcm_file)
+        return spans
+
+    async def _run(self, work: Callable[[], Awaitable[list[tuple[str, float]]]]):
+        '''
+        slot 을 얻어 work() 를 실행하고 단계별 소요 시간을 기록.
+        timeout 이 지나면 바로 실패하지만, slot 은 work() 가 정리를 마칠 때
+        (worker process 의 작업은 끝날 때, subprocess 는 종료될 때) 돌려줌.
+        '''
+        if self._in_flight >= self.slots + self.max_queue:
+            raise RenderBusyError(self.retry_after)
+
+        if self._executor is None:
+            raise Exception('Render farm is not started.')
+
+        await self._acquire()
+
+        task = asyncio.ensure_future(work())
+        task.add_done_callback(self._release)
+        try:
+            spans = await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except BaseException:
+            task.cancel()
+            raise
+
+        metrics.observe(spans)
+
+    async def _acquire(self):
+        '''
+        대기열에 들어가 slot 을 얻음. timeout 안에 얻지 못하면 RenderBusyError.
+        '''
+        self._in_flight += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._in_flight -= 1
+            raise RenderBusyError(self.retry_after)
+        except BaseException:
+            self._in_flight -= 1
+            raise
+
+        self._rendering += 1
+
+    def _release_slot(self):
+        self._rendering -= 1
+        self._in_flight -= 1
+        self._semaphore.release()
+
+    def _release(self, task: asyncio.Task):
+        self._release_slot()
+        # timeout 으로 기다리지 않게 된 작업의 오류는 여기서 확인해야 경고가 남지 않음.
+        if not task.cancelled():
+            task.exception()
+
+    async def render_parts(
+        self,
+        composition: dict,
+        output_file,
+        profile_path=None,
+        output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+    ):
+        '''
+        generator.compose_parts 의 결과를 output_format 으로 렌더링.
+        여러 번 나오는 section 도 한 번만 합성하고, PCM 을 곡 순서대로 합쳐 한 번에 인코딩함.
+        profile_path 가 주어지면 synth backend 의 렌더링을 cProfile 로 실행하고 결과를 저장.
+        '''
+        await self._run(lambda: self._render_parts(composition, output_file, output_format, profile_path))
+
+    async def render_segment(self, midi, pcm_file):
+        '''
+        section 하나를 16bit stereo PCM 파일로 렌더링.
+        '''
+        await self._run(lambda: self._render_segment(midi, pcm_file))
+
+    async def splice(
+        self,
+        segment_files: list[str],
+        offsets: list[float],
+        output_file: str,
+        output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+    ):
+        '''
+        render_segment 로 렌더링한 section 별 PCM 파일들을 곡에서의 시작 시각 (초) 에 놓고 합쳐서
+        output_format 으로 인코딩.
+        '''
+        await self._run(lambda: self._splice(segment_files, offsets, output_file, output_format))
+
+    async def stream(self, midi, output_format: OutputFormat = FORMATS[DEFAULT_FORMAT]) -> RenderStream:
+        '''
+        output_format 으로 인코딩된 음원을 만들어지는 대로 돌려주는 RenderStream 을 반환.
+        응답을 시작하기 전에 거절할 수 있도록 대기열 확인과 slot 대기는 여기서 함.
+        대기열이 가득 찼거나 timeout 안에 slot 을 얻지 못하면 RenderBusyError.
+        backend 와 관계없이 fluidsynth / ffmpeg pipeline 을 사용.
+        '''
+        if self._in_flight >= self.slots + self.max_queue:
+            raise RenderBusyError(self.retry_after)
+
+        await self._acquire()
+        return RenderStream(self._stream(midi, output_format), self._release_slot)
+
+    async def _stream(self, midi, output_format: OutputFormat):
+        # timeout 은 fluidsynth / ffmpeg 를 기다린 시간에만 적용. 느린 client 를 기다리는 시간은 제외.
+        spans = []
+        async for chunk in convert.stream_midi_to_audio(
+            midi, self.soundfont, output_format, spans=spans, timeout=self.timeout,
+        ):
+            yield chunk
+
+        metrics.observe(spans)
@@ -0,0 +1,261 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Union
+from app import generator
+from app.util.cache import RenderCache
+from app.util.engine import GenerationEngine
+from app.util.formats import OutputFormat
+from app.util.render import RenderFarm, section_offsets
+
+
+class SongPart:
+    '''
+    곡의 section 하나.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        midi: bytes,
+        beats: float,
+        seed: Union[int, None],
+        segment: str,
+    ):
+        self.name = name
+        self.midi = midi            # section 만 담은 midi. 끝난 뒤 release / reverb 를 위한 여유가 있음.
+        self.beats = beats          # section 의 길이 (박)
+        self.seed = seed            # section 을 다시 만들 때 쓴 seed. 곡의 seed 로 만든 section 은 None.
+        self.segment = segment      # 렌더링한 PCM 의 segment cache key
+
+
+class SongDocument:
+    '''
+    편집할 수 있는 곡.
+
+    곡을 만드는 인자, section 별 seed, bpm 만 있으면 같은 곡을 다시 만들 수 있음.
+    section 별 midi 와 렌더링한 PCM 을 따로 보관하므로, 편집 후에는 바뀐 section 만 다시 렌더링하고
+    곡 순서대로 합쳐서 인코딩함.
+    '''
+
+    def __init__(self, id: str, params: dict):
+        self.id = id
+        self.params = params                        # 곡을 만드는 인자. ex) {'genre': 'retro', 'seed': 3, ...}
+        self.section_seeds: dict[str, int] = {}
+        self.playback_bpm: Union[int, None] = None  # 곡은 그대로 두고 바꾼 bpm
+        self.bpm = 0
+        self.form: list[str] = []
+        self.parts: dict[str, SongPart] = {}
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # 편집과 렌더링이 서로 섞이지 않도록 곡마다 하나씩 진행.
+        self.lock = asyncio.Lock()
+
+    def offsets(self) -> list[float]:
+        '''
+        곡 순서대로 나오는 section 들의 시작 시각 (초).
+        '''
+        return section_offsets(self.form, {name: part.beats for (name, part) in self.parts.items()}, self.bpm)
+
+    def audio_key(self) -> str:
+        # 같은 segment 를 같은 위치에 놓으면 같은 음원.
+        return RenderCache.make_key(
+            segments=[self.parts[name].segment for name in self.form],
+            offsets=self.offsets(),
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            **self.params,
+            'bpm': self.bpm,
+            'form': self.form,
+            'sections': {
+                name: {'seed': part.seed, 'beats': part.beats}
+                for (name, part) in self.parts.items()
+            },
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class SongEditor:
+    '''
+    SongDocument 를 만들고 편집하고 렌더링.
+
+    section 을 다시 만들거나 bpm 을 바꾸면 worker 에서 곡 전체의 section midi 를 다시 만들고
+    (작곡은 렌더링에 비해 매우 짧음), midi 가 바뀐 section 만 다시 렌더링함.
+    section PCM 은 midi 와 soundfont 의 hash 로 저장되므로 같은 section 은 곡이 달라도 한 번만 렌더링.
+    section PCM 은 형식과 관계없이 같으므로, 다른 형식으로 받을 때는 합쳐서 인코딩만 다시 함.
+    곡은 process 안에만 보관되고, max_songs 를 넘으면 오래 사용하지 않은 곡부터 삭제.
+    설정하지 않은 값은 환경변수에서 읽음.
+        SONG_DOCUMENT_MAX           보관할 곡 수 (기본값: 100)
+        SEGMENT_CACHE_DIR           section PCM 을 저장할 디렉토리 (기본값: ./app/assets/segments/)
+        SEGMENT_CACHE_MAX_BYTES     section PCM 의 최대 전체 크기 (기본값: 2GB)
+    '''
+
+    def __init__(
+        self,
+        engine: GenerationEngine,
+        render_farm: RenderFarm,
+        render_caches: dict[str, RenderCache],
+        work_dir: str,
+        max_songs: Union[int, None] = None,
+        segment_dir: Union[str, None] = None,
+        segment_max_bytes: Union[int, None] = None,
+    ):
+        self.engine = engine
+        self.render_farm = render_farm
+        self.render_caches = render_caches      # 형식 이름 -> 그 형식의 음원 cache
+        self.work_dir = work_dir
+        self.max_songs = max_songs or int(os.environ.get('SONG_DOCUMENT_MAX', 100))
+        self.segment_cache = RenderCache(
+            cache_dir=segment_dir or os.environ.get('SEGMENT_CACHE_DIR', './app/assets/segments/'),
+            max_bytes=segment_max_bytes or int(os.environ.get('SEGMENT_CACHE_MAX_BYTES', 2 * 1024 ** 3)),
+            extension='pcm',
+        )
+
+        self._songs: OrderedDict[str, SongDocument] = OrderedDict()   # 오래 사용하지 않은 순서
+
+    def load(self):
+        self.segment_cache.load()
+
+    def get(self, song_id: str) -> Union[SongDocument, None]:
+        song = self._songs.get(song_id)
+        if song is not None:
+            self._songs.move_to_end(song_id)
+        return song
+
+    async def create(self, params: dict) -> SongDocument:
+        song = SongDocument(uuid.uuid4().hex, params)
+        await self._compose(song, {}, None)
+
+        self._songs[song.id] = song
+        while len(self._songs) > self.max_songs:
+            self._songs.popitem(last=False)
+        return song
+
+    async def regenerate(self, song: SongDocument, section: str, seed: int) -> list[str]:
+        '''
+        section 을 seed 로 다시 만들고 바뀐 section 이름을 반환.
+        '''
+        if section not in song.parts:
+            raise Exception(f'Unknown section: {section}')
+
+        async with song.lock:
+            return await self._compose(song, {**song.section_seeds, section: seed}, song.playback_bpm)
+
+    async def set_bpm(self, song: SongDocument, bpm: int) -> list[str]:
+        '''
+        곡은 그대로 두고 bpm 만 바꾸고, 바뀐 section 이름을 반환.
+        '''
+        async with song.lock:
+            return await self._compose(song, song.section_seeds, bpm)
+
+    async def _compose(
+        self,
+        song: SongDocument,
+        section_seeds: dict[str, int],
+        playback_bpm: Union[int, None],
+    ) -> list[str]:
+        '''
+        section 별 midi 를 다시 만들어 song 에 반영. 실패하면 song 은 바뀌지 않음.
+        '''
+        result = await self.engine.run(
+            generator.compose_parts,
+            **song.params,
+            section_seeds=section_seeds,
+            playback_bpm=playback_bpm,
+        )
+
+        changed = []
+        parts = {}
+        for (name, part) in result['parts'].items():
+            old = song.parts.get(name)
+            if old is not None and old.midi == part['midi']:
+                parts[name] = old
+                continue
+
+            changed.append(name)
+            parts[name] = SongPart(
+                name=name,
+                midi=part['midi'],
+                beats=part['beats'],
+                seed=section_seeds.get(name),
+                segment=RenderCache.make_key(
+                    midi=hashlib.sha256(part['midi']).hexdigest(),
+                    soundfont=self.render_farm.soundfont_hash,
+                ),
+            )
+
+        song.section_seeds = section_seeds
+        song.playback_bpm = playback_bpm
+        song.bpm = result['bpm']
+        song.form = result['form']
+        song.parts = parts
+        song.updated_at = time.time()
+        return changed
+
+    async def _render_segment(self, part: SongPart):
+        if self.segment_cache.get(part.segment) is not None:
+            return
+
+        pcm_file = os.path.join(self.work_dir, f'{uuid.uuid1()}.pcm')
+        try:
+            await self.render_farm.render_segment(part.midi, pcm_file)
+            self.segment_cache.put_file(part.segment, pcm_file)
+        finally:
+            if os.path.exists(pcm_file):
+                os.remove(pcm_file)
+
+    async def _midi(self, song: SongDocument, midi_file: str):
+        midi = await self.engine.run(
+            generator.make_song_bytes,
+            **song.params,
+            section_seeds=song.section_seeds,
+            playback_bpm=song.playback_bpm,
+        )
+        with open(midi_file, 'wb') as f:
+            f.write(midi)
+
+    async def audio(self, song: SongDocument, output_format: OutputFormat) -> str:
+        '''
+        곡을 output_format 으로 받을 경로. 렌더링되지 않은 section 만 렌더링한 뒤 합쳐서 인코딩함.
+        midi 는 렌더링하지 않고 곡 전체를 한 midi 로 만듦.
+        '''
+        render_cache = self.render_caches[output_format.name]
+        async with song.lock:
+            audio_file = render_cache.get(song.audio_key())
+            if audio_file is not None:
+                return audio_file
+
+            if not output_format.rendered:
+                midi_file = os.path.join(self.work_dir, f'{uuid.uuid1()}.{output_format.extension}')
+                try:
+                    await self._midi(song, midi_file)
+                    return render_cache.put_file(song.audio_key(), midi_file)
+                finally:
+                    if os.path.exists(midi_file):
+                        os.remove(midi_file)
+
+            # 같은 section 이 여러 번 나와도 한 번만 렌더링.
+            names = list(dict.fromkeys(song.form))
+            await asyncio.gather(*[self._render_segment(song.parts[name]) for name in names])
+
+            segment_files = []
+            for name in song.form:
+                segment_file = self.segment_cache.get(song.parts[name].segment)
+                if segment_file is None:
+                    raise Exception(f'Segment of {name} is expired.')
+                segment_files.append(segment_file)
+
+            audio_file = os.path.join(self.work_dir, f'{uuid.uuid1()}.{output_format.extension}')
+            try:
+                await self.render_farm.splice(segment_files, song.offsets(), audio_file, output_format)
+                return render_cache.put_file(song.audio_key(), audio_file)
+            finally:
+                if os.path.exists(audio_file):
+                    os.remove(audio_file)
@@ -0,0 +1,246 @@
+import io
+import time
+import subprocess
+from typing import Union
+from app.util.formats import DEFAULT_FORMAT, FORMATS, OutputFormat
+
+# pyfluidsynth 는 libfluidsynth 가 없으면 import 시점에 ImportError 를 냄.
+try:
+    import fluidsynth
+except ImportError:
+    fluidsynth = None
+
+# lameenc 가 없으면 ffmpeg 로 인코딩.
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+TAIL_SECONDS = 1.0          # 마지막 note 이후 release / reverb 가 끝날 때까지 렌더링할 시간
+TAIL_FADE_SECONDS = 0.05    # section 별로 렌더링한 PCM 을 합칠 때 segment 끝을 줄여나가는 시간
+
+# worker process 마다 하나씩 유지되는 synthesizer.
+_synth = None
+
+
+def available() -> bool:
+    return fluidsynth is not None
+
+
+def init_worker(soundfont: str, sample_rate: int = SAMPLE_RATE):
+    '''
+    ProcessPoolExecutor 의 initializer.
+    soundfont 를 한 번만 읽고, worker 가 살아있는 동안 메모리에 유지.
+    '''
+    global _synth
+
+    if fluidsynth is None:
+        raise Exception('pyfluidsynth is not available.')
+
+    _synth = fluidsynth.Synth(samplerate=float(sample_rate))
+    _synth.sfload(soundfont, update_midi_preset=1)
+
+
+def render_pcm(midi: Union[bytes, str], sample_rate: int = SAMPLE_RATE) -> bytes:
+    '''
+    MIDI 를 resident synthesizer 로 렌더링하여 16bit stereo PCM 을 반환.
+    '''
+    if _synth is None:
+        raise Exception('Synth worker is not initialized.')
+
+    # 서버 process 는 render farm 설정만 하므로 worker 에서만 불러옴.
+    import mido
+    import numpy as np
+
+    if isinstance(midi, bytes):
+        midi_file = mido.MidiFile(file=io.BytesIO(midi))
+    else:
+        midi_file = mido.MidiFile(midi)
+
+    # 이전 요청의 note / program 이 남지 않도록 초기화.
+    _synth.system_reset()
+
+    chunks = []
+    current_time = 0.0
+    rendered_frames = 0
+
+    def render_until(time):
+        nonlocal rendered_frames
+        frames = int(round(time * sample_rate)) - rendered_frames
+        if frames > 0:
+            chunks.append(_synth.get_samples(frames))
+            rendered_frames += frames
+
+    # mido 는 tempo 를 반영한 초 단위 delta time 으로 message 를 순회함.
+    for message in midi_file:
+        current_time += message.time
+        if message.is_meta:
+            continue
+
+        render_until(current_time)
+
+        if message.type == 'note_on':
+            _synth.noteon(message.channel, message.note, message.velocity)
+        elif message.type == 'note_off':
+            _synth.noteoff(message.channel, message.note)
+        elif message.type == 'program_change':
+            _synth.program_change(message.channel, message.program)
+        elif message.type == 'control_change':
+            _synth.cc(message.channel, message.control, message.value)
+        elif message.type == 'pitchwheel':
+            _synth.pitch_bend(message.channel, message.pitch)
+
+    render_until(current_time + TAIL_SECONDS)
+
+    if len(chunks) == 0:
+        return b''
+
+    return np.concatenate(chunks).astype(np.int16).tobytes()
+
+
+def encode(
+    pcm: bytes,
+    output_file: str,
+    output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+    sample_rate: int = SAMPLE_RATE,
+):
+    '''
+    sample_rate 의 16bit stereo PCM 을 output_format 으로 인코딩.
+    mp3 는 lameenc 가 있으면 lameenc, 나머지는 ffmpeg 로 인코딩하면서 sample rate 와 channel 을 바꿈.
+    '''
+    if output_format.is_mp3 and lameenc is not None:
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(output_format.bit_rate)
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_out_sample_rate(output_format.sample_rate)
+        encoder.set_quality(output_format.quality if output_format.quality is not None else 2)
+
+        # lameenc 는 입력 channel 수 그대로 인코딩하므로 mono 는 미리 섞음.
+        if output_format.channels == 1:
+            import numpy as np
+
+            stereo = np.frombuffer(pcm, dtype='<i2').reshape(-1, CHANNELS).astype(np.int32)
+            pcm = (stereo.sum(axis=1) // CHANNELS).astype('<i2').tobytes()
+        encoder.set_channels(output_format.channels)
+
+        with open(output_file, 'wb') as f:
+            f.write(encoder.encode(pcm))
+            f.write(encoder.flush())
+        return
+
+    subprocess.run(
+        [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(sample_rate), '-ac', str(CHANNELS), '-i', '-',
+            *output_format.ffmpeg_args(), output_file,
+        ],
+        input=pcm,
+        check=True,
+    )
+
+
+def midi_to_pcm(midi: Union[bytes, str], pcm_file: str) -> list[tuple[str, float]]:
+    '''
+    worker process 에서 실행되는 section 렌더링 작업. PCM 을 파일로 저장.
+    '''
+    start = time.perf_counter()
+    pcm = render_pcm(midi)
+    with open(pcm_file, 'wb') as f:
+        f.write(pcm)
+
+    return [('synthesis', time.perf_counter() - start)]
+
+def _mix(segments: dict, order: list, offsets: list[float], sample_rate: int) -> bytes:
+    '''
+    segments[order[i]] 를 offsets[i] 초에 놓고 더해서 하나의 16bit PCM 으로 만듦.
+
+    segment 는 section 이 끝난 뒤의 release / reverb 까지 담고 있으므로,
+    이어 붙이지 않고 더해야 앞 section 의 울림이 다음 section 위에 자연스럽게 겹침.
+    울림이 남은 채로 segment 가 끝나면 끊기는 소리가 나므로 끝부분은 TAIL_FADE_SECONDS 동안 줄임.
+    '''
+    import numpy as np
+
+    fade_frames = int(TAIL_FADE_SECONDS * sample_rate)
+    faded = {}
+    for (key, segment) in segments.items():
+        segment = segment.astype(np.int32)
+        frames = min(fade_frames, len(segment))
+        if frames > 0:
+            ramp = np.linspace(1, 0, frames, dtype=np.float32)[:, np.newaxis]
+            segment[-frames:] = segment[-frames:] * ramp
+        faded[key] = segment
+
+    starts = [int(round(offset * sample_rate)) for offset in offsets]
+    length = max(start + len(faded[key]) for (start, key) in zip(starts, order))
+
+    mixed = np.zeros((length, CHANNELS), dtype=np.int32)
+    for (start, key) in zip(starts, order):
+        segment = faded[key]
+        mixed[start:start + len(segment)] += segment
+
+    np.clip(mixed, -32768, 32767, out=mixed)
+    return mixed.astype('<i2').tobytes()
+
+
+def splice_pcm(segment_files: list[str], offsets: list[float], sample_rate: int = SAMPLE_RATE) -> bytes:
+    '''
+    section 별 PCM 파일을 곡에서의 시작 시각 (초) 에 놓고 더해서 하나의 PCM 으로 만듦.
+    '''
+    import numpy as np
+
+    # 같은 section 이 여러 번 나오므로 파일은 한 번씩만 읽음.
+    segments = {
+        segment_file: np.fromfile(segment_file, dtype='<i2').reshape(-1, CHANNELS)
+        for segment_file in dict.fromkeys(segment_files)
+    }
+    return _mix(segments, segment_files, offsets, sample_rate)
+
+
+def splice_to_audio(
+    segment_files: list[str],
+    offsets: list[float],
+    output_file: str,
+    output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+    sample_rate: int = SAMPLE_RATE,
+) -> list[tuple[str, float]]:
+    '''
+    worker process 에서 실행되는 작업. sample_rate 로 렌더링한 section 별 PCM 을 합쳐 한 번에 인코딩.
+    '''
+    start = time.perf_counter()
+    pcm = splice_pcm(segment_files, offsets, sample_rate)
+    spliced = time.perf_counter()
+    encode(pcm, output_file, output_format, sample_rate)
+
+    return [('splice', spliced - start), ('encode', time.perf_counter() - spliced)]
+
+
+def parts_to_audio(
+    parts: dict[str, bytes],
+    form: list[str],
+    offsets: list[float],
+    output_file: str,
+    output_format: OutputFormat = FORMATS[DEFAULT_FORMAT],
+) -> list[tuple[str, float]]:
+    '''
+    worker process 에서 실행되는 렌더링 작업.
+    section 별 midi 를 section 마다 한 번씩만 합성하고, 곡 순서대로 합쳐 한 번에 output_format 으로 인코딩.
+    '''
+    import numpy as np
+
+    start = time.perf_counter()
+    segments = {
+        name: np.frombuffer(render_pcm(parts[name]), dtype=np.int16).reshape(-1, CHANNELS)
+        for name in dict.fromkeys(form)
+    }
+    synthesized = time.perf_counter()
+    pcm = _mix(segments, form, offsets, SAMPLE_RATE)
+    spliced = time.perf_counter()
+    encode(pcm, output_file, output_format)
+
+    return [
+        ('synthesis', synthesized - start),
+        ('splice', spliced - synthesized),
+        ('encode', time.perf_counter() - spliced),
+    ]
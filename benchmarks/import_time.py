@@ -0,0 +1,107 @@
+'''
+서버와 작곡 worker 의 import 시간을 `python -X importtime` 으로 측정하고 예산을 넘는지 확인.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --generator-budget-ms 300 --output import_time.json
+
+- 서버 process (app.main) 는 작곡 / 합성에만 쓰는 무거운 module 을 import 하면 안 됨.
+- app 의 module 들이 직접 쓰는 시간 (self time 합계) 이 예산 안이어야 함.
+- 작곡 worker 가 처음 불러오는 app.generator.generator 의 전체 시간이 예산 안이어야 함.
+예산을 넘으면 exit code 1.
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 서버 process 에서 import 되면 안 되는 module.
+SERVER_FORBIDDEN = [
+    'app.generator.generator',
+    'pretty_midi',
+    'pychord',
+    'numpy',
+    'mido',
+    'pydub',
+]
+
+
+def import_times(module: str) -> dict[str, tuple[int, int]]:
+    '''
+    새 interpreter 에서 module 을 import 하고, module 마다 (self, cumulative) 시간 (us) 을 반환.
+    '''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise Exception(f'import {module} failed:\n{result.stderr}')
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def best_of(module: str, repeat: int) -> dict[str, tuple[int, int]]:
+    '''
+    측정값이 흔들리므로 repeat 번 중 module 자신의 cumulative 시간이 가장 짧은 결과를 사용.
+    '''
+    runs = [import_times(module) for _ in range(repeat)]
+    return min(runs, key=lambda times: times[module][1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--server-budget-ms', type=float, default=50, help='app.* module 들의 self time 합계')
+    parser.add_argument('--generator-budget-ms', type=float, default=400, help='app.generator.generator 의 cumulative time')
+    parser.add_argument('--output', help='결과를 저장할 json 파일')
+    args = parser.parse_args()
+
+    server = best_of('app.main', args.repeat)
+    worker = best_of('app.generator.generator', args.repeat)
+
+    server_app_ms = sum(self_us for (name, (self_us, _)) in server.items() if name.split('.')[0] == 'app') / 1000
+    generator_ms = worker['app.generator.generator'][1] / 1000
+    forbidden = [name for name in SERVER_FORBIDDEN if name in server]
+
+    report = {
+        'server_total_ms': server['app.main'][1] / 1000,
+        'server_app_ms': server_app_ms,
+        'server_forbidden_imports': forbidden,
+        'generator_total_ms': generator_ms,
+        'slowest_server_imports': sorted(
+            ({'module': name, 'cumulative_ms': cumulative / 1000} for (name, (_, cumulative)) in server.items()),
+            key=lambda entry: entry['cumulative_ms'],
+            reverse=True,
+        )[:10],
+    }
+
+    failures = []
+    if len(forbidden) > 0:
+        failures.append(f'server imports {", ".join(forbidden)}')
+    if server_app_ms > args.server_budget_ms:
+        failures.append(f'app modules take {server_app_ms:.1f}ms (budget {args.server_budget_ms}ms)')
+    if generator_ms > args.generator_budget_ms:
+        failures.append(f'app.generator.generator takes {generator_ms:.1f}ms (budget {args.generator_budget_ms}ms)')
+    report['failures'] = failures
+
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
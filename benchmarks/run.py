@@ -0,0 +1,311 @@
+'''
+작곡 / 직렬화 / 렌더링 단계별 benchmark.
+
+18 가지 (genre, mood, tempo) 조합을 고정된 seed 로 만들면서 단계마다 시간을 재고 json 으로 저장함.
+같은 seed 와 인자로 만든 곡은 항상 같으므로, 다른 commit 에서 만든 결과와 바로 비교할 수 있음.
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+    python benchmarks/run.py --stages create_part,merge_part --repeat 20
+    python benchmarks/run.py --render    # fluidsynth / ffmpeg 와 soundfont 가 있을 때 렌더링도 측정
+
+단계
+    melody_pattern      section 마다 MelodyPattern 생성
+    build_melody        section 마다 Melody.build_melody
+    build_chord         section 마다 ChordWithPattern.build_chord
+    create_part         section 마다 create_part
+    merge_part          SONG_FORM 순서로 merge_part
+    write_midi          write_midi 로 midi bytes 직렬화
+    pretty_midi_write   디버깅용 PrettyMIDI 로 변환 후 PrettyMIDI.write
+    midi_to_mp3         convert.midi_to_audio_async 로 렌더링 (--render 일 때만)
+    sections_to_mp3     section 마다 한 번씩 합성한 PCM 을 합쳐 인코딩 (--render 일 때만)
+'''
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import contextlib
+from itertools import product
+from typing import Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from app.generator import generator
+from app.generator.midi import write_midi, to_pretty_midi
+from app.generator.module.melody import Melody, MelodyPattern
+from app.util import convert, synth
+from app.util.render import section_offsets
+
+GENRES = ['newage', 'retro']
+MOODS = ['happy', 'sad', 'grand']
+TEMPOS = ['slow', 'moderate', 'fast']
+
+STAGES = [
+    'melody_pattern',
+    'build_melody',
+    'build_chord',
+    'create_part',
+    'merge_part',
+    'write_midi',
+    'pretty_midi_write',
+    'midi_to_mp3',
+    'sections_to_mp3',
+]
+
+RENDER_STAGES = ['midi_to_mp3', 'sections_to_mp3']
+
+DEFAULT_SOUNDFONT = os.path.join(ROOT, 'app', 'assets', 'soundfont.sf2')
+
+
+class Song:
+    '''
+    한 조합의 곡을 만드는 데 필요한 입력과 중간 결과.
+    '''
+
+    def __init__(self, genre: str, mood: str, tempo: str, seed: int):
+        self.genre = genre
+        self.mood = mood
+        self.tempo = tempo
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        (self.bpm, self.sections) = generator.plan_song(genre, mood, tempo, None, 0.7, rng)
+        self.parts = {name: generator.create_part(**section, rng=rng) for (name, section) in self.sections.items()}
+        self.melodies = [
+            Melody(
+                scale=section['scale'],
+                randomness=section['randomness'],
+                chord_progression=section['chord_pattern'].cp,
+                measure=section['measure'],
+                division=16,
+                rng=np.random.default_rng(seed),
+            )
+            for section in self.sections.values()
+        ]
+
+        self.tracks = generator.make_instruments(genre)
+        generator.merge_part([self.parts[name] for name in generator.SONG_FORM], self.tracks)
+        self.tracks = list({id(track): track for track in self.tracks}.values())
+        self.midi = write_midi(self.tracks, self.bpm)
+        self.composition = generator.compose_parts(genre=genre, mood=mood, tempo=tempo, seed=seed)
+
+    @property
+    def name(self) -> str:
+        return f'{self.genre}/{self.mood}/{self.tempo}/{self.seed}'
+
+
+def stage_functions(song: Song, soundfont: str) -> dict[str, Callable[[], object]]:
+    '''
+    단계마다 시간을 잴 함수. 매번 같은 seed 로 시작하므로 반복해도 같은 일을 함.
+    '''
+    def melody_pattern():
+        rng = np.random.default_rng(song.seed)
+        for section in song.sections.values():
+            MelodyPattern(section['randomness'], section['chord_pattern'].cp.bar_length, 16, section['measure'], rng)
+
+    def build_melody():
+        for melody in song.melodies:
+            melody.rng = np.random.default_rng(song.seed)
+            melody.build_melody()
+
+    def build_chord():
+        for section in song.sections.values():
+            section['chord_pattern'].build_chord()
+
+    def create_part():
+        rng = np.random.default_rng(song.seed)
+        for section in song.sections.values():
+            generator.create_part(**section, rng=rng)
+
+    def merge_part():
+        generator.merge_part([song.parts[name] for name in generator.SONG_FORM], generator.make_instruments(song.genre))
+
+    def midi():
+        write_midi(song.tracks, song.bpm)
+
+    def pretty_midi_write():
+        to_pretty_midi(song.tracks, song.bpm).write(io.BytesIO())
+
+    def midi_to_mp3():
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(convert.midi_to_audio_async(song.midi, soundfont, os.path.join(directory, 'song.mp3')))
+
+    def sections_to_mp3():
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(render_sections(song.composition, soundfont, directory))
+
+    return {
+        'melody_pattern': melody_pattern,
+        'build_melody': build_melody,
+        'build_chord': build_chord,
+        'create_part': create_part,
+        'merge_part': merge_part,
+        'write_midi': midi,
+        'pretty_midi_write': pretty_midi_write,
+        'midi_to_mp3': midi_to_mp3,
+        'sections_to_mp3': sections_to_mp3,
+    }
+
+
+async def render_sections(composition: dict, soundfont: str, directory: str):
+    '''
+    RenderFarm 의 subprocess backend 와 같은 순서로 section 별 렌더링.
+    '''
+    parts = composition['parts']
+    form = composition['form']
+    pcm_files = {name: os.path.join(directory, f'{name}.pcm') for name in dict.fromkeys(form)}
+    for (name, pcm_file) in pcm_files.items():
+        await convert.midi_to_pcm_async(parts[name]['midi'], soundfont, pcm_file)
+
+    offsets = section_offsets(form, {name: part['beats'] for (name, part) in parts.items()}, composition['bpm'])
+    synth.splice_to_audio([pcm_files[name] for name in form], offsets, os.path.join(directory, 'song.mp3'))
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1e6)
+
+    return {
+        'min_ms': round(min(samples), 4),
+        'median_ms': round(statistics.median(samples), 4),
+        'mean_ms': round(statistics.fmean(samples), 4),
+        'repeat': repeat,
+    }
+
+
+def can_render(soundfont: str) -> bool:
+    return shutil.which('fluidsynth') is not None and shutil.which('ffmpeg') is not None and os.path.exists(soundfont)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(stages: list[str], seeds: list[int], repeat: int, warmup: int, soundfont: str) -> dict:
+    results: dict[str, dict[str, dict]] = {stage: {} for stage in stages}
+
+    for (genre, mood, tempo) in product(GENRES, MOODS, TEMPOS):
+        for seed in seeds:
+            # 작곡 module 의 디버깅 print 는 결과에 섞이지 않도록 버림.
+            with contextlib.redirect_stdout(io.StringIO()):
+                song = Song(genre, mood, tempo, seed)
+                functions = stage_functions(song, soundfont)
+
+                for stage in stages:
+                    # 렌더링은 오래 걸리므로 한 번만 잼.
+                    if stage in RENDER_STAGES:
+                        results[stage][song.name] = measure(functions[stage], 1, 0)
+                    else:
+                        results[stage][song.name] = measure(functions[stage], repeat, warmup)
+
+            print(f'{song.name} done', file=sys.stderr)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seeds': seeds,
+            'repeat': repeat,
+            'warmup': warmup,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+        'totals': {
+            stage: round(sum(entry['median_ms'] for entry in entries.values()), 4)
+            for (stage, entries) in results.items()
+        },
+    }
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    '''
+    단계별 median 합계를 baseline 과 비교한 표. ratio 가 1 보다 크면 느려진 것.
+    '''
+    lines = [f'{"stage":<20}{"baseline ms":>14}{"current ms":>14}{"ratio":>9}']
+    for (stage, total) in report['totals'].items():
+        base = baseline.get('totals', {}).get(stage)
+        if base is None or base == 0:
+            lines.append(f'{stage:<20}{"-":>14}{total:>14.3f}{"-":>9}')
+            continue
+        lines.append(f'{stage:<20}{base:>14.3f}{total:>14.3f}{total / base:>9.2f}')
+    return lines
+
+
+def regressions(report: dict, baseline: dict, threshold: float) -> list[str]:
+    return [
+        stage
+        for (stage, total) in report['totals'].items()
+        if baseline.get('totals', {}).get(stage) and total / baseline['totals'][stage] > threshold
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=','.join(stage for stage in STAGES if stage not in RENDER_STAGES))
+    parser.add_argument('--render', action='store_true', help='midi_to_mp3, sections_to_mp3 단계도 측정')
+    parser.add_argument('--seeds', default='0', help='쉼표로 구분한 seed 목록')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--soundfont', default=DEFAULT_SOUNDFONT)
+    parser.add_argument('--output', help='결과를 저장할 json 파일 (없으면 stdout)')
+    parser.add_argument('--compare', help='비교할 이전 결과 json 파일')
+    parser.add_argument('--fail-above', type=float, help='baseline 대비 이 비율보다 느려진 단계가 있으면 exit code 1')
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage != '']
+    if args.render:
+        stages += [stage for stage in RENDER_STAGES if stage not in stages]
+
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if len(unknown) > 0:
+        parser.error(f'unknown stages: {", ".join(unknown)}')
+
+    if any(stage in RENDER_STAGES for stage in stages) and not can_render(args.soundfont):
+        print('fluidsynth, ffmpeg or soundfont is missing, skipping render stages', file=sys.stderr)
+        stages = [stage for stage in stages if stage not in RENDER_STAGES]
+
+    report = run(stages, [int(seed) for seed in args.seeds.split(',')], args.repeat, args.warmup, args.soundfont)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(report, baseline)), file=sys.stderr)
+
+        if args.fail_above is not None:
+            slower = regressions(report, baseline, args.fail_above)
+            if len(slower) > 0:
+                print(f'regressed: {", ".join(slower)}', file=sys.stderr)
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()